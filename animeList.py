@@ -1,11 +1,17 @@
+import asyncio
 import json
-from typing import Optional
+from typing import Iterable
 
-import requests
 from bs4 import BeautifulSoup
 
+from asyncFetcher import AsyncFetcher, FetchError
+from config import MAL_URL
+from utils import log
+
 
 class ListAnime:
+    __slots__ = ('title', 'id', 'total_episodes', 'watched_episodes', 'status')
+
     def __init__(self, watchlist_data: dict) -> None:
         self.title = watchlist_data.get('anime_title')
         self.id = str(watchlist_data.get('anime_id'))
@@ -13,8 +19,6 @@ class ListAnime:
         self.watched_episodes = watchlist_data.get('num_watched_episodes')
         self.status = self.convert_status(watchlist_data.get('status'))
 
-        self.data = watchlist_data
-
     def convert_status(self, status_number: int) -> str:
         status_conversion = {1: 'watching',
                              2: 'completed',
@@ -26,9 +30,6 @@ class ListAnime:
     def set_total_episodes(self, total_episodes: int) -> int:
         return total_episodes if total_episodes != 0 else -1
 
-    def get_watchlist_data(self):
-        return self.data
-
     def __repr__(self) -> str:
         return f"Title: {self.title}\n  " \
                f"id: {self.id}\n  " \
@@ -37,13 +38,58 @@ class ListAnime:
 
 
 class AnimeList:
-    def __init__(self, username: str) -> None:
+    def __init__(self, username: str, page_workers: int = 4, mal_url: str = MAL_URL) -> None:
+        """ The MyAnimeList list of a user, empty until it is loaded.
+        :param username: The user whose list is loaded.
+        :param page_workers: The number of list pages to request at once.
+        :param mal_url: The address of myanimelist.
+        """
         self.username = username
-        self.anime_list = self.scrape_anime_list()
+        self.mal_url = mal_url
+        self.page_workers = page_workers
+        # Keyed by mal id
+        self.anime_list = {}
+
+    async def load(self, fetcher: AsyncFetcher) -> 'AnimeList':
+        """ Loads the list with the given fetcher.
+        :return: The loaded list itself.
+        """
+        try:
+            anime_list = await self.load_anime_list_pages(fetcher)
+        except (FetchError, ValueError) as e:
+            log(f"Failed to load anime list pages, falling back to the list page. {e}")
+            anime_list = await self.scrape_anime_list(fetcher)
+
+        self.anime_list = {x.id: x for x in anime_list}
+        return self
+
+    async def load_page(self, fetcher: AsyncFetcher, offset: int) -> list:
+        return json.loads(await fetcher.fetch(f"{self.mal_url}/animelist/{self.username}/load.json",
+                                              params = {'status': 7, 'offset': offset}))
+
+    async def load_anime_list_pages(self, fetcher: AsyncFetcher) -> list:
+        """ Loads the list from its json pages, the list page itself only embeds the first 300 entries. """
+        log("Loading anime list")
+        first_page = await self.load_page(fetcher, 0)
+        anime_list = [ListAnime(x) for x in first_page]
+        page_size = len(first_page)
+        if page_size == 0:
+            return anime_list
+
+        pages = [first_page]
+        # A page shorter than the first one is the last page
+        while all(len(x) == page_size for x in pages):
+            offsets = [len(anime_list) + i * page_size for i in range(self.page_workers)]
+            pages = await asyncio.gather(*(self.load_page(fetcher, x) for x in offsets))
+            for page in pages:
+                anime_list.extend(ListAnime(x) for x in page)
+
+        log(f"Loaded {len(anime_list)} anime from list")
+        return anime_list
 
-    def scrape_anime_list(self) -> list:
-        r = requests.get(f"https://myanimelist.net/animelist/{self.username}?status=7")
-        soup = BeautifulSoup(r.content, 'lxml')
+    async def scrape_anime_list(self, fetcher: AsyncFetcher) -> list:
+        content = await fetcher.fetch(f"{self.mal_url}/animelist/{self.username}", params = {'status': 7})
+        soup = BeautifulSoup(content, 'lxml')
         watchlist_data = json.loads(soup.find('table', {'class': 'list-table'}).get('data-items'))
 
         anime_list = []
@@ -52,8 +98,6 @@ class AnimeList:
 
         return anime_list
 
-    def get_anime(self, mal_id: str) -> Optional[ListAnime]:
-        for anime in self.anime_list:
-            if anime.id == mal_id:
-                return anime
-        return None
+    def get_anime_bulk(self, mal_ids: Iterable[str]) -> dict:
+        """ Gets the list entries for many mal ids, ids that aren't on the list map to None. """
+        return {mal_id: self.anime_list.get(mal_id) for mal_id in mal_ids}
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Optional
+from urllib.parse import urlparse
+
+import aiohttp
+
+from metrics import metrics
+
+
+def get_host(url: str) -> str:
+    return urlparse(url).netloc
+
+
+class FetchError(Exception):
+    def __init__(self, url: str, status: Optional[int], reason: str = '') -> None:
+        """ A request that failed, status is None when no response was received at all. """
+        super().__init__(f"Fetching {url} failed with {status if status is not None else reason}")
+        self.url = url
+        self.status = status
+
+
+class AsyncFetcher:
+    def __init__(self, host_limits: Optional[dict] = None, default_limit: int = 4, timeout: float = 30,
+                 headers: Optional[dict] = None) -> None:
+        """ A connection pool shared by every request of a sync, limiting how many requests each host gets at once.
+
+        Use it as an async context manager, the pool is opened on entering and closed on exiting.
+        :param host_limits: The most requests at once keyed by host, as returned by get_host.
+        :param default_limit: The most requests at once to hosts that aren't in host_limits.
+        :param timeout: Seconds a request may take in total before it fails.
+        :param headers: Headers sent with every request.
+        """
+        self.host_limits = host_limits or {}
+        self.default_limit = default_limit
+        self.timeout = timeout
+        self.headers = headers
+        self.semaphores = {}
+        self.session = None
+
+    async def __aenter__(self) -> 'AsyncFetcher':
+        self.session = aiohttp.ClientSession(timeout = aiohttp.ClientTimeout(total = self.timeout),
+                                             headers = self.headers)
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.session.close()
+
+    def get_semaphore(self, url: str) -> asyncio.Semaphore:
+        # Created on first use so the semaphore belongs to the running event loop
+        host = get_host(url)
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.host_limits.get(host, self.default_limit))
+        return self.semaphores[host]
+
+    async def fetch(self, url: str, params: Optional[dict] = None) -> bytes:
+        """ Gets the content of a url.
+        :raises FetchError: When the request fails or the response isn't successful.
+        """
+        try:
+            async with self.get_semaphore(url):
+                async with self.session.get(url, params = params) as response:
+                    content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise FetchError(url, None, str(e) or type(e).__name__)
+
+        metrics.increment('bytes_fetched', len(content))
+        if response.status >= 400:
+            raise FetchError(url, response.status)
+        return content
@@ -0,0 +1,198 @@
+""" Times the phases of a sync against local stand-ins for plex, myanimelist and anidb.
+
+Run from the repository root, for example:
+    python benchmarks/benchmark.py --shows 2000 --list-size 3000
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+import downloader
+from crossReference import CrossReference
+from mappingIndex import MappingIndex
+from metrics import metrics
+from fakeServers import EPISODES_PER_SEASON, FakeServices, SyntheticLibrary
+
+
+class Benchmark:
+    def __init__(self) -> None:
+        """ Collects the time and peak traced memory of each measured phase. """
+        self.results = []
+
+    def measure(self, name: str, func):
+        """ Runs func as a phase, phases needing a dependency that isn't installed are skipped.
+        :return: What func returned, None when the phase was skipped.
+        """
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = func()
+        except ImportError as e:
+            self.results.append({'phase': name, 'skipped': f"missing dependency {e.name}"})
+            return None
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        self.results.append({'phase': name, 'seconds': elapsed, 'peak_mib': peak / 2 ** 20})
+        return result
+
+    def print_results(self) -> None:
+        print(f"{'phase':<28}{'seconds':>10}{'peak MiB':>10}")
+        for result in self.results:
+            if 'skipped' in result:
+                print(f"{result['phase']:<28}{'skipped, ' + result['skipped']:>20}")
+            else:
+                print(f"{result['phase']:<28}{result['seconds']:>10.3f}{result['peak_mib']:>10.1f}")
+        print(f"max rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+def benchmark_mapping_index(bench: Benchmark, library: SyntheticLibrary, url: str) -> None:
+    database = Database()
+    bench.measure('mapping_xml_download',
+                  lambda: downloader.download_if_changed(f"{url}/files/anime-list-full.xml", 'data/tvdbid_to_anidbid.xml'))
+    index = bench.measure('mapping_index_build', lambda: MappingIndex('data/tvdbid_to_anidbid.xml', database))
+    bench.measure('mapping_index_lookup',
+                  lambda: [index.get_anidb_id(show['tvdb_id'], str(season['number']),
+                                              (season['number'] - 1) * EPISODES_PER_SEASON)
+                           for show, season in library.seasons])
+    bench.measure('cross_reference_build',
+                  lambda: CrossReference('data/anime-offline-database.json',
+                                         f"{url}/files/anime-offline-database.json", database))
+    database.close()
+
+
+def benchmark_mapping_resolve(library: SyntheticLibrary, url: str, workers: int) -> None:
+    from mapping import Mapping
+    from plexConnection import PlexAnime
+
+    database = Database()
+    mapping = Mapping(None, database, workers, fetch_rate = 1_000,
+                      cross_reference_url = f"{url}/files/anime-offline-database.json",
+                      mapping_url = f"{url}/files/anime-list-full.xml", anidb_url = f"{url}/anidb")
+    shows = []
+    for show in library.shows:
+        previous = None
+        for season in show['seasons']:
+            episodes = [SimpleNamespace(index = x, isWatched = x <= season['watched'])
+                        for x in range(1, EPISODES_PER_SEASON + 1)]
+            previous = PlexAnime(show['title'], show['tvdb_id'],
+                                 SimpleNamespace(title = f"Season {season['number']}", seasonNumber = season['number'],
+                                                 leafCount = EPISODES_PER_SEASON, viewedLeafCount = season['watched'],
+                                                 episodes = lambda episodes = episodes: episodes),
+                                 previous)
+            shows.append(previous)
+    mapping.resolve_shows(mapping.split_seasons(shows))
+    mapping.close()
+    database.close()
+
+
+def benchmark_anime_list(bench: Benchmark, library: SyntheticLibrary, url: str) -> None:
+    def load():
+        from animeList import AnimeList
+        from asyncFetcher import AsyncFetcher
+
+        async def load_with_fetcher():
+            async with AsyncFetcher() as fetcher:
+                return await AnimeList('benchmark', mal_url = f"{url}/mal").load(fetcher)
+        return asyncio.run(load_with_fetcher())
+
+    anime_list = bench.measure('anime_list_load', load)
+    if anime_list is not None:
+        bench.measure('anime_list_lookup', lambda: anime_list.get_anime_bulk(x['mal_id'] for _, x in library.seasons))
+
+
+def benchmark_plex_scan(bench: Benchmark, library: SyntheticLibrary, url: str, workers: int) -> None:
+    from datetime import datetime
+
+    def connect():
+        from plexConnection import PlexConnection
+        return PlexConnection(f"{url}/plex", 'benchmark', workers)
+
+    plex_connection = bench.measure('plex_connect', connect)
+    if plex_connection is not None:
+        bench.measure('plex_scan_full', lambda: plex_connection.scan_library('Anime'))
+        bench.measure('plex_scan_incremental',
+                      lambda: plex_connection.scan_library('Anime', datetime.fromtimestamp(library.watermark)))
+
+
+def benchmark_sync(bench: Benchmark, url: str, workers: int) -> None:
+    os.environ.update({'libraries'          : 'Anime',
+                       'server_url'         : f"{url}/plex",
+                       'server_token'       : 'benchmark',
+                       'mal_username'       : 'benchmark',
+                       'mal_password'       : 'benchmark',
+                       'sync_time'          : '00:00',
+                       'scan_workers'       : str(workers),
+                       'anidb_workers'      : str(workers),
+                       'anidb_rate'         : '1000',
+                       'cross_reference_url': f"{url}/files/anime-offline-database.json",
+                       'mapping_url'        : f"{url}/files/anime-list-full.xml",
+                       'anidb_url'          : f"{url}/anidb",
+                       'mal_url'            : f"{url}/mal"})
+
+    def sync():
+        from config import Config
+        from syncHandler import start_sync
+        start_sync(Config(), dry_run = True)
+
+    # The earlier phases filled data/, the cold sync starts from an empty one and resolves every mapping itself,
+    # the warm sync then reuses what it stored
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        os.mkdir('data')
+        try:
+            bench.measure('sync_dry_run_cold', sync)
+            bench.measure('sync_dry_run_warm', sync)
+        finally:
+            os.chdir(cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark a sync against local stand-in servers.')
+    parser.add_argument('--shows', type = int, default = 1000, help = 'Shows in the synthetic plex library.')
+    parser.add_argument('--list-size', type = int, default = 1500, help = 'Entries on the synthetic anime list.')
+    parser.add_argument('--workers', type = int, default = 8, help = 'Workers for scans and anidb fetches.')
+    parser.add_argument('--output', help = 'Also write the results to this json file.')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    library = SyntheticLibrary(args.shows, args.list_size)
+    print(f"{len(library.shows)} shows, {len(library.seasons)} seasons, {len(library.list_entries)} list entries")
+
+    bench = Benchmark()
+    with FakeServices(library) as services, tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        os.mkdir('data')
+        benchmark_mapping_index(bench, library, services.url)
+        bench.measure('mapping_resolve', lambda: benchmark_mapping_resolve(library, services.url, args.workers))
+        benchmark_anime_list(bench, library, services.url)
+        benchmark_plex_scan(bench, library, services.url, args.workers)
+        benchmark_sync(bench, services.url, args.workers)
+        requests_served = services.server.requests
+
+    bench.print_results()
+    print(f"{requests_served} requests served")
+    if metrics.last_summary is not None:
+        for name, span in metrics.last_summary.get('spans').items():
+            print(f"last sync {name}: {span['total']:.3f}s")
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'shows': args.shows, 'list_size': args.list_size, 'results': bench.results}, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
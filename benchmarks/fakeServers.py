@@ -0,0 +1,244 @@
+import json
+import re
+import threading
+import time
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import quoteattr
+
+# Entries per load.json page, the same as myanimelist
+LIST_PAGE_SIZE = 300
+EPISODES_PER_SEASON = 12
+
+
+class SyntheticLibrary:
+    def __init__(self, shows: int, list_size: int, cross_reference_coverage: float = 0.8,
+                 changed_fraction: float = 0.01) -> None:
+        """ Generates matching plex, myanimelist, anidb and mapping data for a library of the given size.
+        :param shows: The number of shows in the plex library.
+        :param list_size: The number of entries on the myanimelist list.
+        :param cross_reference_coverage: The fraction of anidb entries the offline dataset knows about.
+        :param changed_fraction: The fraction of shows changed after the watermark for incremental scans.
+        """
+        self.watermark = int(time.time()) - 86_400
+        self.shows = []
+        anidb_id = 1
+        for i in range(shows):
+            tvdb_id = str(100_000 + i)
+            seasons = []
+            for season in range(1, 2 + i % 3):
+                seasons.append({'number'  : season,
+                                'key'     : str(1_000_000 + i * 10 + season),
+                                'anidb_id': str(anidb_id),
+                                'mal_id'  : str(50_000 + anidb_id),
+                                'watched' : (i + season) % (EPISODES_PER_SEASON + 1)})
+                anidb_id += 1
+
+            changed = i < shows * changed_fraction
+            self.shows.append({'key'       : str(10_000 + i),
+                               'tvdb_id'   : tvdb_id,
+                               'title'     : f"Show {i}",
+                               'updated_at': self.watermark + 3_600 if changed else self.watermark - 86_400,
+                               # Every tenth show is numbered absolutely in the mapping xml
+                               'absolute'  : i % 10 == 0,
+                               'seasons'   : seasons})
+
+        self.anidb_count = anidb_id - 1
+        self.cross_referenced = {str(x) for x in range(1, self.anidb_count + 1)
+                                 if (x * 7919) % 100 < cross_reference_coverage * 100}
+        self.list_entries = self.create_list_entries(list_size)
+
+    @property
+    def seasons(self) -> list:
+        return [(show, season) for show in self.shows for season in show['seasons']]
+
+    def create_list_entries(self, list_size: int) -> list:
+        entries = []
+        for show, season in self.seasons[:list_size]:
+            entries.append({'anime_id'            : int(season['mal_id']),
+                            'anime_title'         : f"{show['title']} Season {season['number']}",
+                            'anime_num_episodes'  : EPISODES_PER_SEASON,
+                            'num_watched_episodes': max(0, season['watched'] - 1),
+                            'status'              : 1})
+        # Fill the rest of the list with anime that aren't in the library
+        for i in range(len(entries), list_size):
+            entries.append({'anime_id'            : 900_000 + i,
+                            'anime_title'         : f"Other {i}",
+                            'anime_num_episodes'  : EPISODES_PER_SEASON,
+                            'num_watched_episodes': EPISODES_PER_SEASON,
+                            'status'              : 2})
+        return entries
+
+    def mapping_xml(self) -> bytes:
+        lines = ['<?xml version="1.0" encoding="utf-8"?>', '<anime-list>']
+        for show in self.shows:
+            offset = 0
+            for season in show['seasons']:
+                default_season = 'a' if show['absolute'] else str(season['number'])
+                episode_offset = f' episodeoffset="{offset}"' if show['absolute'] and offset else ''
+                lines.append(f'  <anime anidbid="{season["anidb_id"]}" tvdbid="{show["tvdb_id"]}" '
+                             f'defaulttvdbseason="{default_season}"{episode_offset}>')
+                lines.append(f'    <name>{escape(show["title"])}</name>')
+                lines.append('    <mapping-list>')
+                lines.append(f'      <mapping anidbseason="0" tvdbseason="0">;1-{season["number"]};</mapping>')
+                lines.append('    </mapping-list>')
+                lines.append('  </anime>')
+                offset += EPISODES_PER_SEASON
+        # Entries without a tvdb id make up a large part of the real file
+        for i in range(len(self.shows)):
+            lines.append(f'  <anime anidbid="{800_000 + i}" tvdbid="movie" defaulttvdbseason="1"><name>Movie {i}</name></anime>')
+        lines.append('</anime-list>')
+        return '\n'.join(lines).encode()
+
+    def cross_reference_json(self) -> bytes:
+        data = [{'sources': [f"https://anidb.net/anime/{x}", f"https://myanimelist.net/anime/{50_000 + int(x)}"],
+                 'title'  : f"Anime {x}"} for x in sorted(self.cross_referenced, key = int)]
+        return json.dumps({'data': data}).encode()
+
+    def anidb_page(self, anidb_id: str) -> bytes:
+        if not anidb_id.isdigit() or not 1 <= int(anidb_id) <= self.anidb_count:
+            return None
+        return (f'<html><head><title>Anime {anidb_id} - AniDB</title></head><body>'
+                f'<div class="resources"><a class="i_icon i_resource_mal brand" '
+                f'href="https://myanimelist.net/anime/{50_000 + int(anidb_id)}"></a></div>'
+                f'{"<p>filler</p>" * 200}</body></html>').encode()
+
+    def list_page(self, offset: int) -> bytes:
+        return json.dumps(self.list_entries[offset:offset + LIST_PAGE_SIZE]).encode()
+
+    def list_html(self) -> bytes:
+        items = escape(json.dumps(self.list_entries[:LIST_PAGE_SIZE]), quote = True)
+        return f'<html><body><table class="list-table" data-items="{items}"></table></body></html>'.encode()
+
+    @staticmethod
+    def media_container(elements: list, start: int = 0, size: int = None) -> bytes:
+        total = len(elements)
+        if size is not None:
+            elements = elements[start:start + size]
+        return (f'<?xml version="1.0" encoding="UTF-8"?>\n<MediaContainer size="{len(elements)}" totalSize="{total}">'
+                + ''.join(elements) + '</MediaContainer>').encode()
+
+    def show_directory(self, show: dict) -> str:
+        watched = sum(x['watched'] for x in show['seasons'])
+        return (f'<Directory ratingKey="{show["key"]}" key="/library/metadata/{show["key"]}/children" '
+                f'guid="com.plexapp.agents.thetvdb://{show["tvdb_id"]}?lang=en" type="show" '
+                f'title={quoteattr(show["title"])} index="1" librarySectionID="1" '
+                f'leafCount="{len(show["seasons"]) * EPISODES_PER_SEASON}" viewedLeafCount="{watched}" '
+                f'childCount="{len(show["seasons"])}" addedAt="{self.watermark - 86_400 * 30}" '
+                f'updatedAt="{show["updated_at"]}" lastViewedAt="{show["updated_at"]}"/>')
+
+    @staticmethod
+    def season_directory(show: dict, season: dict) -> str:
+        return (f'<Directory ratingKey="{season["key"]}" key="/library/metadata/{season["key"]}/children" '
+                f'parentRatingKey="{show["key"]}" parentKey="/library/metadata/{show["key"]}" '
+                f'parentTitle={quoteattr(show["title"])} type="season" title="Season {season["number"]}" '
+                f'index="{season["number"]}" librarySectionID="1" leafCount="{EPISODES_PER_SEASON}" '
+                f'viewedLeafCount="{season["watched"]}"/>')
+
+    @staticmethod
+    def episode_video(show: dict, season: dict, index: int) -> str:
+        key = f"{season['key']}{index:03}"
+        return (f'<Video ratingKey="{key}" key="/library/metadata/{key}" parentRatingKey="{season["key"]}" '
+                f'grandparentRatingKey="{show["key"]}" grandparentTitle={quoteattr(show["title"])} type="episode" '
+                f'title="Episode {index}" index="{index}" parentIndex="{season["number"]}" librarySectionID="1" '
+                f'viewCount="{1 if index <= season["watched"] else 0}"/>')
+
+    def plex_response(self, path: str, query: dict, headers) -> bytes:
+        start = int(query.get('X-Plex-Container-Start', [headers.get('X-Plex-Container-Start', 0)])[0])
+        size = query.get('X-Plex-Container-Size', [headers.get('X-Plex-Container-Size')])[0]
+        size = int(size) if size is not None else None
+
+        if path in ('', '/'):
+            return (b'<?xml version="1.0" encoding="UTF-8"?>\n<MediaContainer size="0" friendlyName="Fake Plex" '
+                    b'machineIdentifier="fake" version="1.18.0.0" myPlex="0" platform="Linux"/>')
+        if path == '/library':
+            return self.media_container([])
+        if path == '/library/sections':
+            return self.media_container(['<Directory key="1" type="show" title="Anime" '
+                                         'agent="com.plexapp.agents.thetvdb" scanner="Plex Series Scanner" '
+                                         'language="en" uuid="fake-section" refreshing="0"/>'])
+        if path == '/library/sections/1/all':
+            if query.get('type') == ['3']:
+                return self.media_container([self.season_directory(show, season) for show, season in self.seasons],
+                                            start, size)
+            return self.media_container([self.show_directory(x) for x in self.shows], start, size)
+
+        match = re.fullmatch(r'/library/metadata/(\d+)(/children)?', path)
+        if match:
+            show = next((x for x in self.shows if x['key'] == match.group(1)), None)
+            if show is None:
+                # Seasons list their episodes
+                show, season = next(((x, y) for x, y in self.seasons if y['key'] == match.group(1)), (None, None))
+                if season is None or not match.group(2):
+                    return None
+                return self.media_container([self.episode_video(show, season, x)
+                                             for x in range(1, EPISODES_PER_SEASON + 1)])
+            if match.group(2):
+                return self.media_container([self.season_directory(show, x) for x in show['seasons']])
+            return self.media_container([self.show_directory(show)])
+        return None
+
+
+class FakeServices:
+    def __init__(self, library: SyntheticLibrary) -> None:
+        """ Serves a synthetic library as plex, myanimelist, anidb and the mapping files on one local port.
+
+        Each service lives under its own path prefix: /plex, /mal, /anidb and /files.
+        """
+        self.library = library
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeServicesHandler)
+        self.server.library = library
+        self.server.requests = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeServicesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests += 1
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        library = self.server.library
+        content_type = 'text/html'
+        body = None
+
+        if url.path == '/files/anime-list-full.xml':
+            body, content_type = library.mapping_xml(), 'application/xml'
+        elif url.path == '/files/anime-offline-database.json':
+            body, content_type = library.cross_reference_json(), 'application/json'
+        elif url.path.startswith('/anidb/anime/'):
+            body = library.anidb_page(url.path.rsplit('/', 1)[-1])
+        elif re.fullmatch(r'/mal/animelist/[^/]+/load\.json', url.path):
+            body, content_type = library.list_page(int(query.get('offset', ['0'])[0])), 'application/json'
+        elif re.fullmatch(r'/mal/animelist/[^/]+', url.path):
+            body = library.list_html()
+        elif url.path.startswith('/plex'):
+            body, content_type = library.plex_response(url.path[len('/plex'):], query, self.headers), 'text/xml'
+
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -1,12 +1,73 @@
 import json
 import os
 
+MAL_URL = 'https://myanimelist.net'
+ANIDB_URL = 'https://anidb.net'
+MAPPING_XML_URL = 'https://raw.githubusercontent.com/ScudLee/anime-lists/master/anime-list-full.xml'
+CROSS_REFERENCE_URL = ('https://raw.githubusercontent.com/manami-project/anime-offline-database/master/'
+                       'anime-offline-database-minified.json')
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.88 Safari/537.36'
+
+
+class Account:
+    def __init__(self, mal_username: str, mal_password: str, server_token: str, libraries: list) -> None:
+        """ A plex user whose watched episodes are synced to their own myanimelist account. """
+        self.mal_username = mal_username
+        self.mal_password = mal_password
+        self.server_token = server_token
+        self.libraries = libraries
+
 
 class Config:
     def __init__(self):
-        self.libraries = os.environ.get('libraries').split()
+        self.libraries = os.environ.get('libraries', '').split()
         self.server_token = os.environ.get('server_token')
         self.server_url = os.environ.get('server_url')
         self.mal_username = os.environ.get('mal_username')
         self.mal_password = os.environ.get('mal_password')
         self.sync_time = os.environ.get('sync_time')
+        # 'http' updates the list directly and falls back to the web driver, 'driver' only uses the web driver
+        self.list_writer = os.environ.get('list_writer', 'http')
+        self.scan_workers = int(os.environ.get('scan_workers', 8))
+        self.anidb_workers = int(os.environ.get('anidb_workers', 4))
+        # Anidb pages fetched per second
+        self.anidb_rate = float(os.environ.get('anidb_rate', 0.5))
+        # Offline anidb to myanimelist dataset, set to an empty value to only use data/anime-offline-database.json
+        self.cross_reference_url = os.environ.get('cross_reference_url', CROSS_REFERENCE_URL)
+        # Updates applied at once, each worker logs in with its own session
+        self.update_workers = int(os.environ.get('update_workers', 1))
+        # Updates started per second across all workers
+        self.update_rate = float(os.environ.get('update_rate', 1))
+        # Days an update pushed to myanimelist is trusted for before it is pushed again
+        self.push_cache_days = int(os.environ.get('push_cache_days', 30))
+        # Port to receive plex webhooks on, webhooks are ignored when not set
+        self.webhook_port = int(os.environ.get('webhook_port')) if os.environ.get('webhook_port') else None
+        # Address the webhook listener binds to, set to 0.0.0.0 when plex runs on another machine
+        self.webhook_host = os.environ.get('webhook_host', '127.0.0.1')
+        # Webhooks without this value as their token query parameter are rejected, none are when not set
+        self.webhook_token = os.environ.get('webhook_token') or None
+        # Seconds to wait for more webhooks before syncing the scrobbled seasons
+        self.webhook_debounce = float(os.environ.get('webhook_debounce', 60))
+        # Seconds the web driver waits for elements and between checks while waiting
+        self.driver_timeout = float(os.environ.get('driver_timeout', 10))
+        self.driver_poll_interval = float(os.environ.get('driver_poll_interval', 0.25))
+        # Port to serve prometheus metrics of the last sync on, not served when not set
+        self.metrics_port = int(os.environ.get('metrics_port')) if os.environ.get('metrics_port') else None
+        # Where myanimelist, anidb and the mapping xml are reached, only changed to point at local stand-ins
+        self.mal_url = os.environ.get('mal_url', MAL_URL)
+        self.anidb_url = os.environ.get('anidb_url', ANIDB_URL)
+        self.mapping_url = os.environ.get('mapping_url', MAPPING_XML_URL)
+        # Seconds a request to myanimelist or anidb may take before it fails
+        self.fetch_timeout = float(os.environ.get('fetch_timeout', 30))
+        # Days between full library scans, shows that didn't change are skipped in between
+        self.full_scan_days = int(os.environ.get('full_scan_days', 7))
+        # Json list of plex users synced to their own myanimelist accounts in the same run, each with a mal_username,
+        # mal_password, server_token and optionally libraries. Only the account above is synced when not set
+        self.accounts = self.load_accounts(os.environ.get('accounts'))
+
+    def load_accounts(self, accounts: str) -> list:
+        if not accounts:
+            return [Account(self.mal_username, self.mal_password, self.server_token, self.libraries)]
+
+        return [Account(x['mal_username'], x['mal_password'], x.get('server_token', self.server_token),
+                        x.get('libraries', self.libraries)) for x in json.loads(accounts)]
@@ -0,0 +1,159 @@
+import json
+import os
+import re
+import urllib.error
+from typing import Optional
+
+from database import Database
+import downloader
+from utils import log
+
+ANIDB_SOURCE = re.compile(r'^https?://anidb\.net/anime/(\d+)$')
+MAL_SOURCE = re.compile(r'^https?://myanimelist\.net/anime/(\d+)$')
+
+
+class DatasetReader:
+    def __init__(self, f, chunk_size: int = 1 << 16) -> None:
+        """ Reads the entries of a json dataset one at a time, so the whole file is never held in memory at once.
+        :param f: The text file the dataset is read from.
+        :param chunk_size: The number of characters read from the file at a time.
+        """
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+
+    def fill(self) -> bool:
+        """ Reads the next chunk of the file into the buffer, dropping what was already read.
+        :return: Whether anything was left to read.
+        """
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self) -> str:
+        """ Skips whitespace and returns the next character without reading it, an empty string at the end. """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer) or not self.fill():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, characters: str) -> str:
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Expected one of {characters} in {self.f.name}, found {character or 'the end'}")
+        self.position += 1
+        return character
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # The value carries on in the next chunk
+                if self.fill():
+                    continue
+                raise
+
+            # A number cut off by the end of the buffer carries on in the next chunk
+            if (end == len(self.buffer) or self.buffer[end] in '0123456789.eE+-') and self.fill():
+                continue
+            self.position = end
+            return value
+
+    def entries(self, key: str):
+        """ Yields the items of the list under key in the top level object, other values are read and dropped. """
+        self.expect('{')
+        if self.peek() == '}':
+            return
+
+        while True:
+            name = self.read_value()
+            self.expect(':')
+            if name != key:
+                self.read_value()
+            elif self.expect('[') and self.peek() == ']':
+                self.position += 1
+            else:
+                while True:
+                    yield self.read_value()
+                    if self.expect(',]') == ']':
+                        break
+
+            if self.expect(',}') == '}':
+                return
+
+
+class CrossReference:
+    def __init__(self, filepath: str, url: Optional[str], database: Database) -> None:
+        """ Offline anidb_id to mal_id lookups from an anime-offline-database style json file.
+
+        Every entry of the file's data list has a sources list of urls to the same anime on different sites.
+        :param filepath: Where the dataset is saved.
+        :param url: Where the dataset is refreshed from, None to only use the file already at filepath.
+        :param database: The database the lookups are indexed in.
+        """
+        self.filepath = filepath
+        self.url = url
+        self.database = database
+        self.update_dataset()
+        self.load_index()
+
+    @property
+    def available(self) -> bool:
+        return os.path.exists(self.filepath)
+
+    def update_dataset(self) -> None:
+        if not self.url:
+            return
+
+        log("Checking for a new cross reference dataset")
+        try:
+            if downloader.download_if_changed(self.url, self.filepath):
+                log("Downloaded new cross reference dataset")
+        except (urllib.error.URLError, OSError) as e:
+            log(f"Failed to refresh cross reference dataset. {e}")
+
+    def get_stamp(self) -> str:
+        """ Identifies the version of the dataset the index was built from. """
+        stat = os.stat(self.filepath)
+        return json.dumps([stat.st_size, int(stat.st_mtime)])
+
+    def load_index(self) -> None:
+        if not self.available:
+            return
+
+        stamp = self.get_stamp()
+        if self.database.get_meta('cross_reference_source') == stamp:
+            return
+
+        self.build_index()
+        self.database.set_meta('cross_reference_source', stamp)
+
+    def build_index(self) -> None:
+        """ Streams the dataset into the index, only the source urls of one entry are kept in memory at a time. """
+        log("Building anidb_id to mal_id cross reference")
+        rows = []
+        with open(self.filepath, 'r', encoding = 'utf-8') as f:
+            for anime in DatasetReader(f).entries('data'):
+                sources = anime.get('sources', [])
+                anidb_ids = [m.group(1) for m in map(ANIDB_SOURCE.match, sources) if m]
+                mal_ids = [m.group(1) for m in map(MAL_SOURCE.match, sources) if m]
+                # Entries merging several myanimelist entries can't say which one an anidb entry is
+                if len(mal_ids) == 1:
+                    rows.extend((anidb_id, mal_ids[0]) for anidb_id in anidb_ids)
+
+        with self.database.transaction():
+            self.database.execute('DELETE FROM anidb_to_mal')
+            self.database.executemany('INSERT OR IGNORE INTO anidb_to_mal (anidb_id, mal_id) VALUES (?, ?)', rows)
+        log(f"Indexed {len(rows)} anidb_id to mal_id links")
+
+    def get_mal_id(self, anidb_id: str) -> Optional[str]:
+        rows = self.database.execute('SELECT mal_id FROM anidb_to_mal WHERE anidb_id = ?', (anidb_id,))
+        return rows[0][0] if rows else None
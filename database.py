@@ -0,0 +1,112 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS mappings (
+    tvdb_id TEXT NOT NULL,
+    season TEXT NOT NULL,
+    mal_id TEXT,
+    PRIMARY KEY (tvdb_id, season)
+);
+CREATE TABLE IF NOT EXISTS mapping_errors (
+    tvdb_id TEXT NOT NULL,
+    season TEXT NOT NULL,
+    title TEXT,
+    PRIMARY KEY (tvdb_id, season)
+);
+-- Replaced by anidb_segments
+DROP TABLE IF EXISTS anidb_index;
+DROP TABLE IF EXISTS anidb_ranges;
+CREATE TABLE IF NOT EXISTS anidb_segments (
+    tvdb_id TEXT NOT NULL,
+    season TEXT NOT NULL,
+    segment_start INTEGER NOT NULL,
+    segment_end INTEGER,
+    anidb_id TEXT NOT NULL,
+    episode_offset INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS anidb_segments_tvdb ON anidb_segments (tvdb_id, season);
+CREATE TABLE IF NOT EXISTS anidb_to_mal (
+    anidb_id TEXT PRIMARY KEY,
+    mal_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS anidb_unlinked (
+    anidb_id TEXT PRIMARY KEY,
+    checked_at REAL
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    account TEXT NOT NULL,
+    mal_id TEXT NOT NULL,
+    watched_episodes INTEGER,
+    status TEXT,
+    synced_at REAL,
+    PRIMARY KEY (account, mal_id)
+);
+"""
+
+
+class Database:
+    def __init__(self, filepath: str = 'data/plex_mal_sync.db') -> None:
+        """ Embedded sqlite database holding the mappings, the anidb index and the sync state.
+        :param filepath: Where the database is saved.
+        """
+        # Every statement commits on its own unless it runs inside a transaction
+        self.connection = sqlite3.connect(filepath, isolation_level = None, check_same_thread = False)
+        self.lock = threading.RLock()
+        with self.lock:
+            # The write ahead log makes each commit a cheap append instead of a page rewrite
+            self.connection.execute('PRAGMA journal_mode = WAL')
+            self.connection.execute('PRAGMA synchronous = NORMAL')
+            self.connection.executescript(SCHEMA)
+
+    def execute(self, sql: str, parameters = ()) -> list:
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def executemany(self, sql: str, parameters) -> None:
+        with self.lock:
+            self.connection.executemany(sql, parameters)
+
+    @contextmanager
+    def transaction(self):
+        """ Groups statements into a single commit, rolling them back if anything fails. """
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                yield self
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def get_meta(self, key: str) -> Optional[str]:
+        rows = self.execute('SELECT value FROM meta WHERE key = ?', (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        self.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def get_sync_state(self, account: str, mal_id: str) -> Optional[tuple]:
+        """ Gets the watched episodes, status and time last pushed to MyAnimeList for an anime. """
+        rows = self.execute('SELECT watched_episodes, status, synced_at FROM sync_state '
+                            'WHERE account = ? AND mal_id = ?', (account, mal_id))
+        return rows[0] if rows else None
+
+    def set_sync_state(self, account: str, mal_id: str, watched_episodes: int, status: Optional[str]) -> None:
+        self.execute('INSERT OR REPLACE INTO sync_state (account, mal_id, watched_episodes, status, synced_at) '
+                     'VALUES (?, ?, ?, ?, ?)', (account, mal_id, watched_episodes, status, time.time()))
+
+    def checkpoint(self) -> None:
+        """ Moves the write ahead log into the database file. """
+        self.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,67 @@
+import hashlib
+import os
+import tempfile
+import urllib.error
+import urllib.request
+
+from metrics import metrics
+from utils import log
+import utils
+
+
+def get_validators_path(filepath: str) -> str:
+    return f"{filepath}.validators.json"
+
+
+def download_if_changed(url: str, filepath: str, timeout: int = 60) -> bool:
+    """ Downloads a url to a file only when the remote content differs from the local copy.
+
+    The ETag and Last-Modified validators of the last download are stored next to the file and sent
+    back so an unchanged file costs a single 304 response. The new content is written to a temporary
+    file which atomically replaces the old one, so the file never goes missing if a download fails.
+    :param url: The url of the file to download.
+    :param filepath: Where the file is saved.
+    :param timeout: Seconds to wait for the server before giving up.
+    :return: Whether the file content changed.
+    """
+    validators_path = get_validators_path(filepath)
+    validators = utils.load_json(validators_path) if os.path.exists(filepath) else {}
+
+    request = urllib.request.Request(url)
+    if validators.get('etag'):
+        request.add_header('If-None-Match', validators.get('etag'))
+    if validators.get('last_modified'):
+        request.add_header('If-Modified-Since', validators.get('last_modified'))
+
+    try:
+        response = urllib.request.urlopen(request, timeout = timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            log(f"{os.path.basename(filepath)} is up to date")
+            return False
+        raise
+
+    directory = os.path.dirname(filepath) or '.'
+    fd, temp_path = tempfile.mkstemp(dir = directory, prefix = '.download-')
+    try:
+        sha1 = hashlib.sha1()
+        with response, os.fdopen(fd, 'wb') as f:
+            while chunk := response.read(65_536):
+                sha1.update(chunk)
+                f.write(chunk)
+                metrics.increment('bytes_fetched', len(chunk))
+
+        new_validators = {'etag'         : response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified'),
+                          'sha1'         : sha1.hexdigest()}
+
+        # Servers that ignore the validators still send the same content back
+        changed = new_validators['sha1'] != validators.get('sha1') or not os.path.exists(filepath)
+        if changed:
+            os.replace(temp_path, filepath)
+        utils.save_json(new_validators, validators_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return changed
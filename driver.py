@@ -2,16 +2,29 @@ import selenium.common
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.common.by import By
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support import expected_conditions as ec
 from selenium.webdriver.support.wait import WebDriverWait
+from typing import Optional
+from metrics import metrics
 from utils import log
+import utils
 import time
 
+# Privacy notices MyAnimeList shows, in the order they should be accepted
+NOTICE_SELECTORS = ['.details_save--1ja7w',  # Larger privacy notice
+                    '.intro_acceptAll--23PPA',  # Medium privacy notice
+                    'button']  # First small privacy notice
+
 
 class Driver:
-    def __init__(self):
-        """ Creates chromedriver with options for the object. """
+    def __init__(self, timeout: float = 10, poll_interval: float = 0.25):
+        """ Creates chromedriver with options for the object.
+
+        :param timeout: Seconds to wait for elements to load in.
+        :param poll_interval: Seconds between checks while waiting for an element or retrying a click.
+        """
         log(f"Starting web driver")
         # Setup chrome options
         chrome_options = webdriver.ChromeOptions()
@@ -19,12 +32,23 @@ class Driver:
         chrome_options.add_argument('--disable-gpu')
         chrome_options.add_argument('--no-sandbox')
 
+        # Images and web fonts are never looked at so don't download them
+        chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+        chrome_options.add_argument('--disable-remote-fonts')
+        chrome_options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+
         # Remove unwanted logs
         chrome_options.add_argument("--log-level=3")
-        self.driver = webdriver.Chrome(chrome_options = chrome_options)
+
+        # Hand pages over once the DOM is ready instead of waiting for every resource
+        capabilities = DesiredCapabilities.CHROME.copy()
+        capabilities['pageLoadStrategy'] = 'eager'
+
+        self.driver = webdriver.Chrome(chrome_options = chrome_options, desired_capabilities = capabilities)
         self.driver.set_window_position(0, 0)
         self.driver.set_window_size(2560, 1080)
-        self.wait = WebDriverWait(self.driver, 10)
+        self.poll_interval = poll_interval
+        self.wait = WebDriverWait(self.driver, timeout, poll_frequency = poll_interval)
         log(f"Web driver started")
 
     def get(self, url):
@@ -82,7 +106,7 @@ class Driver:
                     attempts += 1
                     ele.click()
                 except WebDriverException:
-                    time.sleep(1)
+                    time.sleep(self.poll_interval)
                     continue
                 break
 
@@ -107,42 +131,65 @@ class Driver:
         :param wait: Whether or not to wait for the element to load in.
         :param css_selector: The css selector to locate the target element.
         """
-        try:
-            self.find_element(css_selector, wait)
-            return True
-        except selenium.common.exceptions.TimeoutException and selenium.common.exceptions.NoSuchElementException:
-            return False
-
-    def accept_privacy_notices(self):
-        notice_clicked = False
+        if wait:
+            self.wait_for(css_selector)
 
-        while not notice_clicked:
-            log("Checking for notices")
-            # Larger privacy notice
-            if notice_clicked := self.element_exists('.details_save--1ja7w', False):
-                self.click('.details_save--1ja7w', False)
+        # Looking elements up as a list returns straight away instead of raising when there are none
+        return len(self.driver.find_elements_by_css_selector(css_selector)) > 0
 
-            # Click the medium privacy notice
-            elif notice_clicked := self.element_exists('.intro_acceptAll--23PPA', False):
-                self.click('.intro_acceptAll--23PPA', False)
+    def find_notice(self) -> Optional[str]:
+        """ Finds which privacy notice is shown with a single query to the page.
 
-            # First small privacy notice
-            elif notice_clicked := self.element_exists('button', False):
-                self.click('button', False)
+        :return: The selector of the first notice in NOTICE_SELECTORS on the page.
+        """
+        return self.driver.execute_script("for (const selector of arguments[0]) {"
+                                          "    if (document.querySelector(selector)) return selector;"
+                                          "}"
+                                          "return null;", NOTICE_SELECTORS)
 
-            else:
-                # No notices were found
-                notice_clicked = True
-            log("Notices done")
+    def accept_privacy_notices(self):
+        log("Checking for notices")
+        if (selector := self.find_notice()) is not None:
+            self.click(selector, False)
+        log("Notices done")
 
     def apply_cookies(self):
         self.get(f"https://myanimelist.net/")
         self.driver.add_cookie({'name': 'm_gdpr_mdl', 'value': '1'})
 
+    def restore_cookies(self, mal_username: str) -> bool:
+        """ Applies the saved session cookies and checks whether they are still logged in. """
+        cookies = utils.load_cookies(mal_username)
+        if not cookies:
+            return False
+
+        log("Restoring saved MyAnimeList session")
+        self.get(f"https://myanimelist.net/")
+        for cookie in cookies:
+            # Selenium only accepts these keys back, session cookies saved over http have no expiry or domain and
+            # chromedriver rejects those as empty values, without a domain the cookie goes to the current page
+            self.driver.add_cookie({k: v for k, v in cookie.items()
+                                    if k in ('name', 'value', 'domain', 'path', 'expiry', 'secure', 'httpOnly') and
+                                    not (k in ('domain', 'expiry') and not v)})
+        self.driver.add_cookie({'name': 'm_gdpr_mdl', 'value': '1'})
+        self.get(f"https://myanimelist.net/")
+        return self.logged_in(wait = False)
+
+    def save_cookies(self, mal_username: str) -> None:
+        utils.save_cookies(self.driver.get_cookies(), mal_username)
+
     def login_myanimelist(self, mal_username: str, mal_password: str) -> bool:
         if self.logged_in(wait = False):
             return True
 
+        with metrics.span('login'):
+            return self.log_in(mal_username, mal_password)
+
+    def log_in(self, mal_username: str, mal_password: str) -> bool:
+        if self.restore_cookies(mal_username):
+            log(f"Restored session for user {mal_username}")
+            return True
+
         for i in range(1, 6):
             log(f"Logging into MyAnimeList attempt: {i}")
             self.apply_cookies()
@@ -155,6 +202,7 @@ class Driver:
 
             if self.logged_in():
                 log(f"Logged in successfully as user {mal_username}")
+                self.save_cookies(mal_username)
                 return True
         return False
 
@@ -194,8 +242,11 @@ class Driver:
         self.send_keys('#myinfo_watchedeps', watched_episodes)
 
     def confirm_update(self):
+        # Wait for whichever button the page has so an update doesn't wait out the timeout on the add button
+        self.wait_for('.js-anime-add-button, .js-anime-update-button')
+
         # Click add or update
-        if self.element_exists('.js-anime-add-button'):
+        if self.element_exists('.js-anime-add-button', wait = False):
             self.click('.js-anime-add-button')
         else:
             self.click('.js-anime-update-button')
@@ -203,3 +254,23 @@ class Driver:
     def quit(self):
         """ Close the driver. """
         self.driver.quit()
+
+
+class LazyDriver:
+    def __init__(self, timeout: float = 10, poll_interval: float = 0.25):
+        """ Stands in for a Driver and only starts the browser the first time it is used. """
+        self.instance = None
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def __getattr__(self, name):
+        # Only called for attributes the wrapper doesn't define, which is every Driver method
+        if self.instance is None:
+            self.instance = Driver(self.timeout, self.poll_interval)
+        return getattr(self.instance, name)
+
+    def quit(self):
+        """ Close the driver if it was started, it will be started again if used afterwards. """
+        if self.instance is not None:
+            self.instance.quit()
+            self.instance = None
@@ -0,0 +1,227 @@
+from enum import Enum
+from typing import Optional
+from urllib.parse import urlparse
+
+import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+from config import Account, Config, MAL_URL, USER_AGENT
+from driver import Driver
+from metrics import metrics
+from updateData import UpdateData
+from utils import log
+import utils
+
+
+class UpdateResult(Enum):
+    UPDATED = 'updated'
+    LOGIN_FAILED = 'login failed'
+    INVALID_ID = 'invalid id'
+    FAILED = 'failed'
+
+
+class ListWriter:
+    """ Applies updates to a MyAnimeList list. """
+
+    def update(self, update: UpdateData) -> UpdateResult:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class DriverListWriter(ListWriter):
+    def __init__(self, driver: Driver, mal_username: str, mal_password: str) -> None:
+        """ Updates the list by filling in the anime page forms with the web driver. """
+        self.driver = driver
+        self.mal_username = mal_username
+        self.mal_password = mal_password
+
+    def update(self, update: UpdateData) -> UpdateResult:
+        if not self.driver.login_myanimelist(self.mal_username, self.mal_password):
+            return UpdateResult.LOGIN_FAILED
+
+        # Load the anime page
+        if not self.driver.load_anime_page(update.mal_id):
+            return UpdateResult.INVALID_ID
+
+        log("Filling in information")
+        self.driver.add_to_list()
+        if update.status is None:
+            update.set_myanimelist_total_episodes(self.driver.get_total_episodes())
+
+        self.driver.select_watch_status(update.status)
+        self.driver.enter_episodes_seen(update.watched_episodes)
+        self.driver.confirm_update()
+        return UpdateResult.UPDATED
+
+
+class HttpListWriter(ListWriter):
+    status_conversion = {'watching'     : 1,
+                         'completed'    : 2,
+                         'on hold'      : 3,
+                         'dropped'      : 4,
+                         'plan to watch': 6}
+
+    def __init__(self, mal_username: str, mal_password: str, mal_url: str = MAL_URL) -> None:
+        """ Updates the list through the same json endpoints the MyAnimeList website uses. """
+        self.mal_url = mal_url
+        self.mal_username = mal_username
+        self.mal_password = mal_password
+        self.csrf_token = None
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': USER_AGENT})
+        self.session.mount('https://', HTTPAdapter(pool_connections = 1, pool_maxsize = 4, max_retries = 2))
+
+    @staticmethod
+    def get_csrf_token(html: bytes) -> Optional[str]:
+        ele = BeautifulSoup(html, 'lxml').find('meta', {'name': 'csrf_token'})
+        return ele.get('content') if ele is not None else None
+
+    @staticmethod
+    def is_logged_in_page(html: bytes) -> bool:
+        return b'header-profile-link' in html
+
+    def restore_session(self) -> bool:
+        """ Applies the saved session cookies and checks whether they are still logged in. """
+        cookies = utils.load_cookies(self.mal_username)
+        if not cookies:
+            return False
+
+        log("Restoring saved MyAnimeList session")
+        for cookie in cookies:
+            self.session.cookies.set(cookie.get('name'), cookie.get('value'),
+                                     domain = cookie.get('domain', ''), path = cookie.get('path', '/'),
+                                     expires = cookie.get('expiry'), secure = cookie.get('secure', False))
+
+        r = self.session.get(f"{self.mal_url}/", timeout = 30)
+        if not r.ok or not self.is_logged_in_page(r.content):
+            self.session.cookies.clear()
+            return False
+
+        self.csrf_token = self.get_csrf_token(r.content)
+        return self.csrf_token is not None
+
+    def save_session(self) -> None:
+        cookies = []
+        for c in self.session.cookies:
+            cookie = {'name'  : c.name,
+                      'value' : c.value,
+                      'domain': c.domain or f".{urlparse(self.mal_url).hostname}",
+                      'path'  : c.path,
+                      'secure': c.secure}
+            # Session cookies have no expiry, which the web driver won't accept as an empty value
+            if c.expires is not None:
+                cookie['expiry'] = c.expires
+            cookies.append(cookie)
+        utils.save_cookies(cookies, self.mal_username)
+
+    def login(self) -> bool:
+        if self.csrf_token is not None:
+            return True
+
+        with metrics.span('login'):
+            return self.log_in()
+
+    def log_in(self) -> bool:
+        if self.restore_session():
+            log(f"Restored session for user {self.mal_username}")
+            return True
+
+        log("Logging into MyAnimeList over http")
+        r = self.session.get(f"{self.mal_url}/login.php", timeout = 30)
+        csrf_token = self.get_csrf_token(r.content)
+        if csrf_token is None:
+            return False
+
+        r = self.session.post(f"{self.mal_url}/login.php",
+                              data = {'user_name' : self.mal_username,
+                                      'password'  : self.mal_password,
+                                      'cookie'    : 1,
+                                      'sublogin'  : 'Login',
+                                      'submit'    : 1,
+                                      'csrf_token': csrf_token},
+                              timeout = 30)
+        if not r.ok or not self.is_logged_in_page(r.content):
+            return False
+
+        # The token is rotated on login
+        self.csrf_token = self.get_csrf_token(r.content) or csrf_token
+        log(f"Logged in successfully as user {self.mal_username}")
+        self.save_session()
+        return True
+
+    def get_total_episodes(self, mal_id: str) -> Optional[int]:
+        """ Gets the total episodes of an anime, -1 when unknown or None if the anime doesn't exist. """
+        r = self.session.get(f"{self.mal_url}/anime/{mal_id}", timeout = 30)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+
+        ele = BeautifulSoup(r.content, 'lxml').find(id = 'curEps')
+        if ele is None or not ele.text.strip().isdigit():
+            return -1
+        return int(ele.text.strip())
+
+    def update(self, update: UpdateData) -> UpdateResult:
+        try:
+            if not self.login():
+                return UpdateResult.LOGIN_FAILED
+
+            if update.status is None:
+                total_episodes = self.get_total_episodes(update.mal_id)
+                if total_episodes is None:
+                    return UpdateResult.INVALID_ID
+                update.set_myanimelist_total_episodes(total_episodes)
+
+            # Anime not yet on the list have no myanimelist watched episodes
+            action = 'add' if update.myanimelist_watched_episodes is None else 'edit'
+            r = self.session.post(f"{self.mal_url}/ownlist/anime/{action}.json",
+                                  json = {'anime_id'            : int(update.mal_id),
+                                          'status'              : self.status_conversion.get(update.status),
+                                          'num_watched_episodes': update.watched_episodes,
+                                          'csrf_token'          : self.csrf_token},
+                                  timeout = 30)
+        except requests.RequestException as e:
+            log(f"Http update failed. {e}")
+            return UpdateResult.FAILED
+
+        if not r.ok:
+            log(f"Http update failed with status {r.status_code}. {r.text[:200]}")
+            # A rejected token means the session expired, log in again on the next update
+            if r.status_code in (400, 401, 403):
+                self.csrf_token = None
+            return UpdateResult.FAILED
+
+        return UpdateResult.UPDATED
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class FallbackListWriter(ListWriter):
+    def __init__(self, primary: ListWriter, fallback: ListWriter) -> None:
+        """ Uses the fallback writer for any update the primary writer couldn't apply. """
+        self.primary = primary
+        self.fallback = fallback
+
+    def update(self, update: UpdateData) -> UpdateResult:
+        result = self.primary.update(update)
+        if result in (UpdateResult.UPDATED, UpdateResult.INVALID_ID):
+            return result
+
+        log("Falling back to the web driver")
+        return self.fallback.update(update)
+
+    def close(self) -> None:
+        self.primary.close()
+        self.fallback.close()
+
+
+def create_list_writer(config: Config, account: Account, driver: Driver) -> ListWriter:
+    driver_writer = DriverListWriter(driver, account.mal_username, account.mal_password)
+    if config.list_writer == 'driver':
+        return driver_writer
+
+    return FallbackListWriter(HttpListWriter(account.mal_username, account.mal_password, config.mal_url), driver_writer)
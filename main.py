@@ -1,10 +1,30 @@
+import argparse
 import time
 import schedule
 from config import Config
-from syncHandler import start_sync
+from metrics import metrics
+from syncHandler import start_sync, start_season_sync
+from webhookListener import WebhookListener
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Syncs Plex with MyAnimeList')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'print the planned updates once and exit')
+    args = parser.parse_args()
+
     config = Config()
+    if args.dry_run:
+        start_sync(config, dry_run = True)
+        raise SystemExit
+
+    if config.metrics_port is not None:
+        metrics.start_server(config.metrics_port)
+
+    # Webhooks sync scrobbled seasons straight away, the daily sync reconciles anything they missed
+    if config.webhook_port is not None:
+        libraries = sorted({x for account in config.accounts for x in account.libraries})
+        WebhookListener(config.webhook_port, lambda seasons: start_season_sync(config, seasons), libraries,
+                        config.webhook_debounce, host = config.webhook_host, token = config.webhook_token).start()
+
     schedule.every().day.at(config.sync_time).do(lambda: start_sync(config))
     start_sync(config)
 
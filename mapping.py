@@ -1,109 +1,220 @@
+import asyncio
 import os
-import time
-import urllib.request
-import xml.etree.ElementTree as et
+import urllib.error
 from typing import Optional
 from bs4 import BeautifulSoup
+from asyncFetcher import AsyncFetcher, FetchError, get_host
+from config import ANIDB_URL, CROSS_REFERENCE_URL, MAPPING_XML_URL, USER_AGENT
+from crossReference import CrossReference
+from database import Database
+import downloader
+from mappingIndex import MappingIndex
+from mappingStore import MappingStore
+from metrics import metrics
+from rateLimiter import TokenBucket
 from utils import log
-import utils
+
+# Anidb entries without a myanimelist link are checked again after this many seconds
+UNLINKED_RECHECK_AGE = 30 * 86_400
 
 
 class Mapping:
-    def __init__(self, driver):
+    def __init__(self, driver, database: Database, fetch_workers: int = 4, fetch_rate: float = 0.5,
+                 fetch_retries: int = 3, cross_reference_url: Optional[str] = CROSS_REFERENCE_URL,
+                 mapping_url: str = MAPPING_XML_URL, anidb_url: str = ANIDB_URL):
+        """ Maps tvdb seasons to myanimelist ids.
+        :param driver: The web driver used for anidb pages that can't be fetched over http.
+        :param database: The database the mappings are stored in.
+        :param fetch_workers: The number of anidb pages to fetch at once.
+        :param fetch_rate: The most anidb pages to fetch per second.
+        :param fetch_retries: The number of times to try fetching an anidb page.
+        :param cross_reference_url: Where the offline anidb_id to mal_id dataset is refreshed from.
+        :param mapping_url: Where the tvdb_id to anidb_id xml is refreshed from.
+        :param anidb_url: The address of anidb.
+        """
+        self.mapping_url = mapping_url
+        self.anidb_url = anidb_url
         self.update_mapping_xml()
-        self.xml_tvdb_id_to_anidb_id = et.parse('data/tvdbid_to_anidbid.xml').getroot()
-        self.tvdb_id_to_mal_id = self.load_tvdb_id_to_mal_id()
-        self.mapping_errors = self.load_mapping_errors()
+        self.anidb_index = MappingIndex('data/tvdbid_to_anidbid.xml', database)
+        self.cross_reference = CrossReference('data/anime-offline-database.json', cross_reference_url, database)
+        self.store = MappingStore(database)
         self.driver = driver
+        self.fetch_workers = fetch_workers
+        self.fetch_retries = fetch_retries
+        self.rate_limiter = TokenBucket(fetch_rate)
         self.remove_solved_mapping_errors()
+        self.store.flush()
 
-    def load_tvdb_id_to_mal_id(self) -> dict:
-        log("Loading tvdb_id to mal_id")
-        return utils.load_json('data/tvdbid_to_malid.json')
-
-    def save_tvdb_id_to_mal_id(self) -> None:
-        log("Saving tvdb_id to mal_id")
-        utils.save_json(self.tvdb_id_to_mal_id, 'data/tvdbid_to_malid.json')
+    def checkpoint(self) -> None:
+        """ Clears solved mapping errors, saves every change made since the last checkpoint and writes the mapping
+        errors out to data/mapping_errors.json.
+        """
+        self.remove_solved_mapping_errors()
+        self.store.flush()
 
-    def load_mapping_errors(self) -> dict:
-        log("Loading mapping errors")
-        return utils.load_json('data/mapping_errors.json')
+    def close(self) -> None:
+        self.checkpoint()
+        self.store.close()
 
-    def save_mapping_errors(self) -> None:
-        log("Saving mapping errors")
-        utils.save_json(self.mapping_errors, 'data/mapping_errors.json')
+    def create_fetcher(self) -> AsyncFetcher:
+        """ A fetcher for lookups made outside of a sync, syncs pass their shared one instead. """
+        return AsyncFetcher({get_host(self.anidb_url): self.fetch_workers}, headers = {'User-Agent': USER_AGENT})
 
     def update_mapping_xml(self) -> None:
-        if not os.path.exists('data/tvdbid_to_anidbid.xml'):
-            self.download_tvdb_anidb_mapping()
-
-        mapping_file_age = time.time() - os.path.getctime('data/tvdbid_to_anidbid.xml')
-        # Replace if the old file is 7 days old
-        if mapping_file_age >= 603_800:
-            self.download_tvdb_anidb_mapping()
-
-    def download_tvdb_anidb_mapping(self) -> None:
-        log("Downloading new XML mapping file")
-        if os.path.exists('data/tvdbid_to_anidbid.xml'):
-            os.remove('data/tvdbid_to_anidbid.xml')
-
-        urllib.request.urlretrieve('https://raw.githubusercontent.com/ScudLee/anime-lists/master/anime-list-full.xml',
-                                   'data/tvdbid_to_anidbid.xml')
-
-    def get_mal_id(self, tvdb_id: str, season: str, create: bool = True) -> Optional[str]:
-        mal_id = self.tvdb_id_to_mal_id.get(tvdb_id, {}).get(season)
-        if mal_id is not None:
-            return mal_id
-
-        return self.create_tvdb_id_to_mal_id_mapping(tvdb_id, season) if create else None
-
-    def create_tvdb_id_to_mal_id_mapping(self, tvdb_id: str, season: str):
-        log("Creating new anime mapping")
-        mal_id = None
-        if (anidb_id := self.get_anidb_id_from_tvdb_id(tvdb_id, season)) is not None:
-            mal_id = self.get_mal_id_from_anidb_id(anidb_id)
-
-        self.tvdb_id_to_mal_id[tvdb_id] = {**self.tvdb_id_to_mal_id.get(tvdb_id, {}), **{season: mal_id}}
-        self.save_tvdb_id_to_mal_id()
-        self.remove_solved_mapping_errors()
-        return mal_id
-
-    def get_mal_id_from_anidb_id(self, anidb_id: str):
-        soup = BeautifulSoup(self.driver.get_html(f'https://anidb.net/anime/{anidb_id}'), 'lxml')
+        log("Checking for a new XML mapping file")
+        try:
+            if downloader.download_if_changed(self.mapping_url, 'data/tvdbid_to_anidbid.xml'):
+                log("Downloaded new XML mapping file")
+        except (urllib.error.URLError, OSError) as e:
+            # An old mapping file is still usable until the next successful refresh
+            if not os.path.exists('data/tvdbid_to_anidbid.xml'):
+                raise
+            log(f"Failed to refresh XML mapping file, using the existing one. {e}")
+
+    def get_mal_id(self, tvdb_id: str, season: str) -> Optional[str]:
+        """ Gets a stored mapping, new mappings are only created by resolve_shows. """
+        return self.store.get_mapping(tvdb_id, season)
+
+    def resolve_shows(self, shows: list) -> None:
+        asyncio.run(self.resolve_shows_async(shows))
+
+    async def resolve_shows_async(self, shows: list, fetcher: Optional[AsyncFetcher] = None) -> None:
+        """ Fills in the mal_id of every show in a single pass, creating the mappings that don't exist yet.
+
+        Shows that still can't be mapped are added to the mapping errors.
+        :param shows: PlexAnime objects split by split_seasons, typically every show from a scan.
+        :param fetcher: The fetcher anidb pages are requested with.
+        """
+        for show in shows:
+            if show.mal_id is None:
+                show.mal_id = self.store.get_mapping(show.tvdb_id, show.mapping_season)
+
+        unresolved = [x for x in shows if x.mal_id is None]
+        if not unresolved:
+            return
+
+        mal_ids = await self.create_mappings_async({(x.tvdb_id, x.mapping_season): x.anidb_id for x in unresolved},
+                                                   fetcher)
+        for show in unresolved:
+            show.mal_id = mal_ids.get((show.tvdb_id, show.mapping_season))
+            if show.mal_id is None:
+                self.add_to_mapping_errors(show.tvdb_id, show.title, show.mapping_season)
+
+    def split_seasons(self, shows: list) -> list:
+        """ Splits every show into a part for each anidb entry its episodes are mapped to.
+
+        Shows the index has no segments for, or none within their episodes, are kept whole, they end up in the
+        mapping errors. Splitting can load the episodes of a season from plex.
+        :return: The PlexAnime parts of the shows.
+        """
+        parts = []
+        for show in shows:
+            segments = self.anidb_index.get_segments(show.tvdb_id, show.season_number)
+            # Only absolutely numbered shows need the episodes of the seasons before this one
+            if not segments and self.anidb_index.get_segments(show.tvdb_id, 'a'):
+                segments = self.anidb_index.get_season_segments(show.tvdb_id, show.season_number,
+                                                                show.absolute_start)
+            show_parts = show.split(segments) if segments else []
+            if segments and not show_parts:
+                log(f"No anidb entry starts within the episodes of {show.title}")
+            parts.extend(show_parts or [show])
+        return parts
+
+    async def create_mappings_async(self, anidb_ids: dict, fetcher: Optional[AsyncFetcher] = None) -> dict:
+        """ Creates mappings for many seasons, fetching their anidb pages concurrently.
+        :param anidb_ids: The anidb_id of every (tvdb_id, season) to create a mapping for, None when there is none.
+        :return: The new mal_id of every (tvdb_id, season).
+        """
+        log(f"Creating {len(anidb_ids)} new anime mappings")
+
+        # The offline dataset answers most lookups, anidb is only asked about what it doesn't know
+        mal_ids = {}
+        for anidb_id in {x for x in anidb_ids.values() if x is not None}:
+            if (mal_id := self.cross_reference.get_mal_id(anidb_id)) is not None:
+                mal_ids[anidb_id] = mal_id
+                metrics.increment('cross_reference_hits')
+
+        unfetched = {x for x in anidb_ids.values() if x is not None and x not in mal_ids and
+                     not self.store.is_unlinked(x, UNLINKED_RECHECK_AGE)}
+        if unfetched:
+            mal_ids.update(await self.fetch_mal_ids(unfetched, fetcher))
+
+        for (tvdb_id, season), anidb_id in anidb_ids.items():
+            self.store.set_mapping(tvdb_id, season, mal_ids.get(anidb_id))
+
+        return {x: mal_ids.get(anidb_id) for x, anidb_id in anidb_ids.items()}
+
+    async def fetch_mal_ids(self, anidb_ids: set, fetcher: Optional[AsyncFetcher] = None) -> dict:
+        """ Gets the mal_ids linked from many anidb pages, anidb ids without a link map to None. """
+        if fetcher is None:
+            async with self.create_fetcher() as fetcher:
+                return await self.fetch_mal_ids(anidb_ids, fetcher)
+
+        anidb_ids = list(anidb_ids)
+        results = await asyncio.gather(*(self.fetch_mal_id_from_anidb_id(x, fetcher) for x in anidb_ids),
+                                       return_exceptions = True)
+        mal_ids = {}
+        failed = []
+        for anidb_id, result in zip(anidb_ids, results):
+            if isinstance(result, FetchError):
+                log(f"Failed to fetch anidb page {anidb_id}. {result}")
+                failed.append(anidb_id)
+                continue
+            if isinstance(result, BaseException):
+                raise result
+
+            mal_ids[anidb_id] = result
+            if result is None:
+                self.store.set_unlinked(anidb_id)
+
+        # Pages anidb refused to serve over http are rendered with the web driver instead
+        loop = asyncio.get_running_loop()
+        for anidb_id in failed:
+            await self.rate_limiter.acquire_async()
+            mal_ids[anidb_id] = await loop.run_in_executor(None, self.get_mal_id_from_anidb_id, anidb_id)
+
+        return mal_ids
+
+    async def fetch_mal_id_from_anidb_id(self, anidb_id: str, fetcher: AsyncFetcher) -> Optional[str]:
+        """ Fetches an anidb page, retrying with backoff when anidb is busy or unreachable. """
+        for attempt in range(self.fetch_retries):
+            await self.rate_limiter.acquire_async()
+            try:
+                with metrics.span('anidb_fetch'):
+                    content = await fetcher.fetch(f"{self.anidb_url}/anime/{anidb_id}")
+            except FetchError as e:
+                if e.status is not None and e.status != 429 and e.status < 500:
+                    raise
+                # Back off before trying again, the last failure gives up straight away
+                if attempt < self.fetch_retries - 1:
+                    await asyncio.sleep(2 ** (attempt + 1))
+                continue
+
+            return self.parse_mal_id(content)
+
+        raise FetchError(f"{self.anidb_url}/anime/{anidb_id}", None,
+                         f"anidb is unavailable after {self.fetch_retries} attempts")
+
+    @staticmethod
+    def parse_mal_id(html) -> Optional[str]:
+        soup = BeautifulSoup(html, 'lxml')
         # Check the two locations for the myanimelist link
         ele = soup.find('a', {'class': 'i_icon i_resource_mal brand'}) or soup.find('a', {'class': 'hide mal'})
-        time.sleep(2)
-        return ele.get('href').rsplit('/')[-1]
+        return ele.get('href').rsplit('/')[-1] if ele is not None else None
 
-    def get_anidb_id_from_tvdb_id(self, tvdb_id: str, season: str) -> Optional[str]:
-        for anime in list(self.xml_tvdb_id_to_anidb_id):
-            if anime.get('tvdbid') == tvdb_id and anime.get('defaulttvdbseason') == season:
-                return anime.get('anidbid')
-        return None
+    def get_mal_id_from_anidb_id(self, anidb_id: str) -> Optional[str]:
+        return self.parse_mal_id(self.driver.get_html(f'{self.anidb_url}/anime/{anidb_id}'))
 
     def add_to_mapping_errors(self, tvdb_id: str, title: str, season: str) -> None:
         self.remove_mapping(tvdb_id, season)
-
-        error = self.mapping_errors.get(tvdb_id, {'title': title, 'seasons': []})
-        if season not in error.get('seasons'):
-            error['seasons'].append(season)
-            self.mapping_errors[tvdb_id] = error
-            self.save_mapping_errors()
+        self.store.add_error(tvdb_id, title, season)
 
     def remove_mapping(self, tvdb_id: str, season: str) -> None:
-        if season in self.tvdb_id_to_mal_id[tvdb_id].keys():
-            self.tvdb_id_to_mal_id[tvdb_id][season] = None
-            self.save_tvdb_id_to_mal_id()
+        if self.store.get_mapping(tvdb_id, season) is not None:
+            self.store.set_mapping(tvdb_id, season, None)
 
     def remove_solved_mapping_errors(self):
         log("Checking mapping errors")
-        changed = False
-        for tvdb_id, data in self.mapping_errors.items():
-            for i, season in enumerate(data.get('seasons')):
-                if self.get_mal_id(tvdb_id, season, create = False) is not None:
-                    changed = True
-                    self.mapping_errors[tvdb_id]['seasons'].pop(i)
-
-        if changed:
-            self.mapping_errors = {k: v for k, v in self.mapping_errors.items() if len(v['seasons']) > 0}
-            self.save_mapping_errors()
+        for tvdb_id, season in self.store.get_errors():
+            if self.get_mal_id(tvdb_id, season) is not None:
+                self.store.remove_error(tvdb_id, season)
@@ -0,0 +1,173 @@
+import json
+import os
+import xml.etree.ElementTree as et
+from typing import Optional
+
+from database import Database
+from utils import log
+
+# Bump whenever the layout of the stored index changes
+INDEX_VERSION = 5
+
+
+class MappingIndex:
+    def __init__(self, xml_path: str, database: Database) -> None:
+        """ Lookup table from (tvdb_id, tvdb season) to anidb ids built from the anime-list xml.
+        :param xml_path: Path to the ScudLee anime-list-full.xml file.
+        :param database: The database the index is stored in.
+        """
+        self.xml_path = xml_path
+        self.database = database
+        self.load_index()
+
+    def get_xml_stamp(self) -> str:
+        """ Identifies the version of the xml file the index was built from. """
+        stat = os.stat(self.xml_path)
+        return json.dumps([INDEX_VERSION, stat.st_size, int(stat.st_mtime)])
+
+    def load_index(self) -> None:
+        stamp = self.get_xml_stamp()
+        if self.database.get_meta('anidb_index_source') == stamp:
+            log("Loaded tvdb_id to anidb_id index")
+            return
+
+        self.build_index()
+        self.database.set_meta('anidb_index_source', stamp)
+
+    def build_index(self) -> None:
+        """ Streams the xml file into the index without keeping its tree in memory.
+
+        Entries are read by tvdb_id and defaulttvdbseason ("a" for absolute numbering) with their episode offset,
+        and ranged mapping-list entries by tvdb_id and the tvdb season they map episodes onto. Only the episode
+        segments worked out from both are stored.
+        """
+        log("Building tvdb_id to anidb_id index")
+        entries = []
+        ranges = []
+        context = et.iterparse(self.xml_path, events = ('start', 'end'))
+        _, root = next(context)
+        for event, element in context:
+            if event != 'end' or element.tag != 'anime':
+                continue
+
+            tvdb_id = element.get('tvdbid')
+            season = element.get('defaulttvdbseason')
+            anidb_id = element.get('anidbid')
+            # Entries that aren't on tvdb use values like 'movie' or 'unknown' as their tvdbid
+            if tvdb_id and tvdb_id.isdigit() and season is not None and anidb_id is not None:
+                entries.append((tvdb_id, season, anidb_id, int(element.get('episodeoffset') or 0)))
+                ranges.extend((tvdb_id, *x) for x in self.read_mapping_ranges(element, anidb_id))
+
+            # Drop every parsed element so memory stays flat while streaming
+            root.clear()
+
+        segments = self.build_segments(entries, ranges)
+
+        with self.database.transaction():
+            self.database.execute('DELETE FROM anidb_segments')
+            self.database.executemany('INSERT INTO anidb_segments '
+                                      '(tvdb_id, season, segment_start, segment_end, anidb_id, episode_offset) '
+                                      'VALUES (?, ?, ?, ?, ?, ?)', segments)
+
+    @staticmethod
+    def build_segments(entries: list, ranges: list) -> list:
+        """ Works out which anidb entry every episode of every tvdb season belongs to.
+
+        An entry covers its default season from the episode after its offset up to the next entry's offset,
+        ranged mappings take precedence over entries for the episodes they cover.
+        :return: (tvdb_id, season, start, end, anidb_id, episode_offset) rows, end is None when open ended.
+        """
+        owners = {}
+        for tvdb_id, season, anidb_id, offset in sorted(entries, key = lambda x: x[3]):
+            season_owners = owners.setdefault((tvdb_id, season), {'ranges': [], 'entries': []})
+            # Entries sharing an offset can't be told apart, the first one keeps it like before
+            if all(x[0] != offset + 1 for x in season_owners['entries']):
+                season_owners['entries'].append([offset + 1, None, anidb_id, offset])
+        for tvdb_id, season, anidb_id, start, end, offset in ranges:
+            owners.setdefault((tvdb_id, season), {'ranges': [], 'entries': []})['ranges'].append(
+                [(start or 1) + offset, end + offset if end is not None else None, anidb_id, offset])
+
+        segments = []
+        for (tvdb_id, season), season_owners in owners.items():
+            entries = season_owners['entries']
+            for entry, following in zip(entries, entries[1:]):
+                entry[1] = following[0] - 1
+
+            candidates = season_owners['ranges'] + entries
+            bounds = sorted({x[0] for x in candidates} | {x[1] + 1 for x in candidates if x[1] is not None})
+            season_segments = []
+            for start, next_start in zip(bounds, bounds[1:] + [None]):
+                owner = next((x for x in candidates if x[0] <= start and (x[1] is None or start <= x[1])), None)
+                if owner is None:
+                    continue
+
+                end = next_start - 1 if next_start is not None else None
+                previous = season_segments[-1] if season_segments else None
+                # Neighbouring pieces of the same entry become one segment
+                if previous is not None and previous[4:] == [owner[2], owner[3]] and previous[3] == start - 1:
+                    previous[3] = end
+                else:
+                    season_segments.append([tvdb_id, season, start, end, owner[2], owner[3]])
+            # Ranges with negative offsets can start before the season's first episode
+            segments.extend((*x[:2], max(1, x[2]), *x[3:]) for x in season_segments if x[3] is None or x[3] >= 1)
+        return segments
+
+    @staticmethod
+    def read_mapping_ranges(anime, anidb_id: str) -> list:
+        """ Reads the ranged mappings of an anime element which map its episodes onto other tvdb seasons. """
+        ranges = []
+        for mapping in anime.iterfind('mapping-list/mapping'):
+            # Only regular anidb episodes are synced, specials live in anidbseason 0
+            if mapping.get('anidbseason') != '1' or mapping.get('tvdbseason') is None:
+                continue
+
+            offset = mapping.get('offset')
+            if offset is None:
+                continue
+
+            start = mapping.get('start')
+            end = mapping.get('end')
+            ranges.append((mapping.get('tvdbseason'), anidb_id,
+                           int(start) if start is not None else None,
+                           int(end) if end is not None else None,
+                           int(offset)))
+        return ranges
+
+    def get_segments(self, tvdb_id: str, season: str) -> list:
+        """ Gets the [start, end, anidb_id, episode_offset] segments of a tvdb season ordered by their first episode.
+
+        Episode e of the season is episode e - episode_offset of the segment's anidb entry, end is None when the
+        segment runs to the end of the season.
+        """
+        return [list(x) for x in self.database.execute('SELECT segment_start, segment_end, anidb_id, episode_offset '
+                                                       'FROM anidb_segments WHERE tvdb_id = ? AND season = ? '
+                                                       'ORDER BY segment_start', (tvdb_id, season))]
+
+    def get_season_segments(self, tvdb_id: str, season: str, absolute_start: Optional[int] = None) -> list:
+        """ Gets the segments of a season, falling back to the absolute numbering of the show.
+        :param absolute_start: The number of episodes before the season in absolute numbering, None when unknown.
+        """
+        segments = self.get_segments(tvdb_id, season)
+        if segments or absolute_start is None:
+            return segments
+
+        # Shift the absolute episode numbers into the season and drop what ends before it
+        season_segments = []
+        for start, end, anidb_id, offset in self.get_segments(tvdb_id, 'a'):
+            if end is not None and end <= absolute_start:
+                continue
+            season_segments.append([max(1, start - absolute_start), end - absolute_start if end is not None else None,
+                                    anidb_id, offset - absolute_start])
+        return season_segments
+
+    def get_anidb_id(self, tvdb_id: str, season: str, absolute_start: Optional[int] = None) -> Optional[str]:
+        """ Gets the anidb_id of a tvdb season, or of the part of it starting at an episode given as season@episode.
+        :param absolute_start: The number of episodes before the season in absolute numbering, None when unknown.
+        """
+        season, _, episode = season.partition('@')
+        segments = self.get_season_segments(tvdb_id, season, absolute_start)
+        if not episode:
+            return segments[0][2] if segments else None
+
+        episode = int(episode)
+        return next((x[2] for x in segments if x[0] <= episode and (x[1] is None or episode <= x[1])), None)
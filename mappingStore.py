@@ -0,0 +1,137 @@
+import os
+import time
+from typing import Optional
+
+from database import Database
+from utils import log
+import utils
+
+
+class MappingStore:
+    def __init__(self, database: Database,
+                 mapping_path: str = 'data/tvdbid_to_malid.json',
+                 errors_path: str = 'data/mapping_errors.json',
+                 overrides_path: str = 'data/mapping_overrides.json') -> None:
+        """ Holds the tvdb_id to mal_id mappings and mapping errors in the database.
+
+        Every change is committed on its own, which the database's write ahead log turns into a small append.
+        The json files previous versions used are imported once.
+        :param database: The database the mappings are stored in.
+        :param mapping_path: Where the tvdb_id to mal_id mappings used to be saved.
+        :param errors_path: Where the mapping errors are written out for users to look through.
+        :param overrides_path: Mappings made by hand in the same format as mapping_path, they take precedence.
+        """
+        self.database = database
+        self.errors_path = errors_path
+        if self.database.get_meta('segment_keys') is None:
+            self.migrate_season_keys()
+        if self.database.get_meta('json_migrated') is None:
+            self.migrate_json(mapping_path, errors_path)
+        self.overrides = self.load_overrides(overrides_path)
+
+    def migrate_json(self, mapping_path: str, errors_path: str) -> None:
+        """ One time import of the json files, which are renamed afterwards so they are never read again.
+
+        Their seasons are stored as the part starting at episode 1, except seasons split over several anidb entries.
+        """
+        log("Moving tvdb_id to mal_id and mapping errors into the database")
+        with self.database.transaction():
+            if os.path.exists(mapping_path):
+                for tvdb_id, seasons in utils.load_json(mapping_path).items():
+                    for season, mal_id in seasons.items():
+                        if not self.is_split(tvdb_id, season):
+                            self.set_mapping(tvdb_id, f"{season}@1", mal_id)
+
+            if os.path.exists(errors_path):
+                for tvdb_id, data in utils.load_json(errors_path).items():
+                    for season in data.get('seasons'):
+                        if not self.is_split(tvdb_id, season):
+                            self.add_error(tvdb_id, data.get('title'), f"{season}@1")
+
+            self.database.set_meta('json_migrated', '1')
+
+        # Keep the old mappings around but out of the way so they aren't mistaken for the live data, the errors
+        # file is written again from the database
+        if os.path.exists(mapping_path):
+            os.replace(mapping_path, f"{mapping_path}.migrated")
+
+    @staticmethod
+    def load_overrides(overrides_path: str) -> dict:
+        """ Reads the mappings made by hand keyed by (tvdb_id, season), a bare season is its part from episode 1. """
+        if not os.path.exists(overrides_path):
+            return {}
+
+        overrides = {(tvdb_id, season if '@' in season else f"{season}@1"): str(mal_id)
+                     for tvdb_id, seasons in utils.load_json(overrides_path).items()
+                     for season, mal_id in seasons.items() if mal_id is not None}
+        log(f"Loaded {len(overrides)} mappings from {overrides_path}")
+        return overrides
+
+    def is_split(self, tvdb_id: str, season: str) -> bool:
+        """ Checks whether the mapping index splits a season over several anidb entries. """
+        return self.database.execute('SELECT COUNT(*) FROM anidb_segments WHERE tvdb_id = ? AND season = ?',
+                                     (tvdb_id, season))[0][0] > 1
+
+    def migrate_season_keys(self) -> None:
+        """ One time move of the mappings and errors stored under a bare season to the part starting at episode 1.
+
+        Seasons split over several anidb entries can't tell which part a bare season meant, they are dropped and
+        resolved again under their season@episode keys.
+        """
+        log("Moving tvdb_id to mal_id mappings to the first part of their season")
+        with self.database.transaction():
+            for table in ('mappings', 'mapping_errors'):
+                # Rows already stored under season@1 are kept over the bare season they clash with
+                self.database.execute(f"UPDATE OR IGNORE {table} SET season = season || '@1' "
+                                      f"WHERE season NOT LIKE '%@%' AND "
+                                      f"(SELECT COUNT(*) FROM anidb_segments WHERE anidb_segments.tvdb_id = "
+                                      f"{table}.tvdb_id AND anidb_segments.season = {table}.season) <= 1")
+                self.database.execute(f"DELETE FROM {table} WHERE season NOT LIKE '%@%'")
+            self.database.set_meta('segment_keys', '1')
+
+    def get_mapping(self, tvdb_id: str, season: str) -> Optional[str]:
+        if (tvdb_id, season) in self.overrides:
+            return self.overrides[(tvdb_id, season)]
+
+        rows = self.database.execute('SELECT mal_id FROM mappings WHERE tvdb_id = ? AND season = ?',
+                                     (tvdb_id, season))
+        return rows[0][0] if rows else None
+
+    def set_mapping(self, tvdb_id: str, season: str, mal_id: Optional[str]) -> None:
+        self.database.execute('INSERT OR REPLACE INTO mappings (tvdb_id, season, mal_id) VALUES (?, ?, ?)',
+                              (tvdb_id, season, mal_id))
+
+    def add_error(self, tvdb_id: str, title: str, season: str) -> None:
+        self.database.execute('INSERT OR IGNORE INTO mapping_errors (tvdb_id, season, title) VALUES (?, ?, ?)',
+                              (tvdb_id, season, title))
+
+    def remove_error(self, tvdb_id: str, season: str) -> None:
+        self.database.execute('DELETE FROM mapping_errors WHERE tvdb_id = ? AND season = ?', (tvdb_id, season))
+
+    def get_errors(self) -> list:
+        """ Gets every mapping error as (tvdb_id, season) pairs. """
+        return self.database.execute('SELECT tvdb_id, season FROM mapping_errors')
+
+    def save_errors(self) -> None:
+        """ Writes the mapping errors out in the format of the errors file previous versions kept. """
+        errors = {}
+        for tvdb_id, season, title in self.database.execute('SELECT tvdb_id, season, title FROM mapping_errors '
+                                                            'ORDER BY tvdb_id, season'):
+            errors.setdefault(tvdb_id, {'title': title, 'seasons': []})['seasons'].append(season)
+        utils.save_json(errors, self.errors_path)
+
+    def is_unlinked(self, anidb_id: str, max_age: float) -> bool:
+        """ Checks whether an anidb entry was recently found to have no myanimelist link. """
+        return bool(self.database.execute('SELECT 1 FROM anidb_unlinked WHERE anidb_id = ? AND checked_at > ?',
+                                          (anidb_id, time.time() - max_age)))
+
+    def set_unlinked(self, anidb_id: str) -> None:
+        self.database.execute('INSERT OR REPLACE INTO anidb_unlinked (anidb_id, checked_at) VALUES (?, ?)',
+                              (anidb_id, time.time()))
+
+    def flush(self) -> None:
+        self.save_errors()
+        self.database.checkpoint()
+
+    def close(self) -> None:
+        self.flush()
@@ -0,0 +1,116 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import log
+import utils
+
+# Runs kept in the metrics file
+RUN_HISTORY = 30
+
+
+def percentile(values: list, fraction: float) -> float:
+    """ Nearest rank percentile of a list of values. """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Metrics:
+    def __init__(self) -> None:
+        """ Collects timing spans and counters for a sync run. """
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.counters = {}
+        self.started = time.time()
+        self.last_summary = None
+
+    def start_run(self) -> None:
+        with self.lock:
+            self.spans = {}
+            self.counters = {}
+            self.started = time.time()
+
+    @contextmanager
+    def span(self, name: str):
+        """ Times the code run inside the with block under the given name. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.spans.setdefault(name, []).append(seconds)
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summarise(self) -> dict:
+        with self.lock:
+            return {'started' : self.started,
+                    'duration': time.time() - self.started,
+                    'spans'   : {name: {'count': len(durations),
+                                        'total': sum(durations),
+                                        'p50'  : percentile(durations, 0.5),
+                                        'p95'  : percentile(durations, 0.95),
+                                        'max'  : max(durations)} for name, durations in self.spans.items()},
+                    'counters': dict(self.counters)}
+
+    def finish_run(self, filepath: str = 'data/sync_metrics.json') -> None:
+        """ Logs a summary of the run and adds it to the metrics file. """
+        summary = self.summarise()
+        self.last_summary = summary
+        for name, span in summary.get('spans').items():
+            log(f"{name}: {span['count']} in {span['total']:.2f}s (p50 {span['p50']:.2f}s, p95 {span['p95']:.2f}s)")
+
+        runs = utils.load_json(filepath).get('runs', [])
+        runs.append(summary)
+        utils.save_json({'runs': runs[-RUN_HISTORY:]}, filepath)
+
+    def to_prometheus(self) -> str:
+        """ Formats the summary of the last finished run in the prometheus text format. """
+        summary = self.last_summary
+        if summary is None:
+            return ''
+
+        lines = ['# TYPE plex_mal_sync_run_duration_seconds gauge',
+                 f"plex_mal_sync_run_duration_seconds {summary['duration']}",
+                 '# TYPE plex_mal_sync_run_started_timestamp_seconds gauge',
+                 f"plex_mal_sync_run_started_timestamp_seconds {summary['started']}",
+                 '# TYPE plex_mal_sync_span_seconds summary']
+        for name, span in summary.get('spans').items():
+            lines.append(f'plex_mal_sync_span_seconds{{span="{name}",quantile="0.5"}} {span["p50"]}')
+            lines.append(f'plex_mal_sync_span_seconds{{span="{name}",quantile="0.95"}} {span["p95"]}')
+            lines.append(f'plex_mal_sync_span_seconds_sum{{span="{name}"}} {span["total"]}')
+            lines.append(f'plex_mal_sync_span_seconds_count{{span="{name}"}} {span["count"]}')
+
+        lines.append('# TYPE plex_mal_sync_count gauge')
+        for name, value in summary.get('counters').items():
+            lines.append(f'plex_mal_sync_count{{counter="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def start_server(self, port: int) -> None:
+        """ Serves the last run's metrics for prometheus to scrape. """
+        server = ThreadingHTTPServer(('', port), MetricsHandler)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        log(f"Serving metrics on port {port}")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+metrics = Metrics()
@@ -1,54 +1,248 @@
+import copy
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from plexapi.exceptions import PlexApiException
 from plexapi.server import PlexServer
 
 from animeList import AnimeList
 from utils import log, load_mapping
-from typing import Optional
-from mapping import Mapping
+from typing import Optional, Tuple
+import utils
 
 
 class PlexConnection(PlexServer):
-    def __init__(self, server_url: str, server_token: str, mapping: Mapping) -> None:
+    def __init__(self, server_url: str, server_token: str, scan_workers: int = 8) -> None:
         """ Connects to plex server with the given url and token.
         :param server_url: The url to the target plex server.
         :param server_token: The token for the target server.
+        :param scan_workers: The number of shows to request seasons for at once.
         """
         log("Connecting to plex server")
         super().__init__(server_url, server_token)
-        self.mapping = mapping
+        self.scan_workers = scan_workers
         log("Plex connection established")
 
-    def get_shows(self, library: str) -> Optional[list]:
-        """ Gets all the shows in a given library.
+    def scan_library(self, library: str, since: Optional[datetime] = None) -> Tuple[list, Optional[datetime]]:
+        """ Gets the shows in a given library along with the latest time any show in it changed.
         :param library: The name of the target library.
-        :return: A list of Show objects from the target library.
+        :param since: Only get shows updated or viewed after this time, everything is scanned when None.
+        :return: A list of Show objects and the watermark to pass as since on the next scan.
         """
-        log(f"Getting shows for library {library}")
+        log(f"Getting {'changed' if since is not None else 'all'} shows for library {library}")
         shows = []
+        watermark = None
         if library in [x.title for x in self.library.sections()]:
-            for media in self.library.section(library).all():
-                shows.extend(self.create_anime_season_objects(media))
+            section = self.library.section(library)
+            medias = section.all()
+            watermark = max((self.get_changed_at(x) for x in medias if self.get_changed_at(x) is not None),
+                            default = None)
+
+            if since is not None:
+                medias = [x for x in medias if self.changed_since(x, since)]
+                log(f"{len(medias)} shows changed since last scan")
+                # Requesting a few changed shows is cheaper than listing every season
+                seasons = {}
+            else:
+                seasons = self.get_seasons_by_show(section)
+
+            # Shows missing from the bulk season listing are requested individually
+            missing = [x for x in medias if str(x.ratingKey) not in seasons]
+            with ThreadPoolExecutor(max_workers = self.scan_workers) as executor:
+                for media, media_seasons in zip(missing, executor.map(lambda x: x.seasons(), missing)):
+                    seasons[str(media.ratingKey)] = media_seasons
+
+            for media in medias:
+                shows.extend(self.create_anime_season_objects(media, seasons.get(str(media.ratingKey), [])))
+
+        return shows, watermark
 
+    def get_show_seasons(self, seasons: dict) -> list:
+        """ Gets specific seasons of specific shows.
+        :param seasons: Season numbers keyed by the rating key of their show.
+        :return: A list of Show objects for the requested seasons.
+        """
+        shows = []
+        for rating_key, season_numbers in seasons.items():
+            try:
+                media = self.fetchItem(int(rating_key))
+            except PlexApiException as e:
+                log(f"Failed to load show {rating_key}. {e}")
+                continue
+
+            shows.extend(self.create_anime_season_objects(media, media.seasons(), season_numbers))
         return shows
 
-    def create_anime_season_objects(self, anime_show):
+    @staticmethod
+    def get_changed_at(media) -> Optional[datetime]:
+        times = [x for x in (media.updatedAt, getattr(media, 'lastViewedAt', None)) if x is not None]
+        return max(times, default = None)
+
+    def changed_since(self, media, since: datetime) -> bool:
+        changed_at = self.get_changed_at(media)
+        return changed_at is None or changed_at > since
+
+    @staticmethod
+    def get_seasons_by_show(section) -> dict:
+        """ Gets every season in a library with a single request, grouped by the rating key of their show. """
+        seasons = {}
+        try:
+            for season in section.search(libtype = 'season'):
+                seasons.setdefault(str(season.parentRatingKey), []).append(season)
+        except PlexApiException as e:
+            log(f"Failed to list seasons for library {section.title}. {e}")
+        return seasons
+
+    def create_anime_season_objects(self, anime_show, seasons: list, season_numbers: Optional[set] = None):
+        """ Creates a PlexAnime for every season of a show.
+        :param seasons: Every season of the show, the earlier ones are needed to number episodes absolutely.
+        :param season_numbers: Only create these seasons, all of them when None.
+        """
         tvdbid = anime_show.guid.rsplit('/')[-1].split('?')[0]
-        return [PlexAnime(anime_show.title, tvdbid, x, self.mapping) for x in anime_show.seasons() if
-                x.title.lower() != 'specials']
+        shows = []
+        previous = None
+        for season in sorted((x for x in seasons if x.title.lower() != 'specials'), key = lambda x: x.seasonNumber):
+            anime = PlexAnime(anime_show.title, tvdbid, season, previous)
+            if season_numbers is None or str(season.seasonNumber) in season_numbers:
+                log(f"Loading anime {anime.title}")
+                shows.append(anime)
+            previous = anime
+        return shows
+
+
+class ScanWatermarks:
+    def __init__(self, full_scan_days: int = 7, filepath: str = 'data/plex_watermarks.json') -> None:
+        """ Remembers up to when each library was scanned so only changed shows need scanning.
+        :param full_scan_days: Days between full scans that reconcile shows missed by the watermark.
+        :param filepath: Where the watermarks are saved.
+        """
+        self.filepath = filepath
+        self.full_scan_interval = full_scan_days * 86_400
+        self.watermarks = utils.load_json(filepath)
+
+    def get_since(self, library: str) -> Optional[datetime]:
+        """ Gets the time shows must have changed after to be scanned, None when a full scan is due. """
+        data = self.watermarks.get(library)
+        if data is None or time.time() - data.get('full_scan', 0) >= self.full_scan_interval:
+            return None
+        return datetime.fromtimestamp(data.get('watermark'))
+
+    def set_watermark(self, library: str, watermark: Optional[datetime], full_scan: bool) -> None:
+        """ Records a library scan once all of its updates have been applied. """
+        data = self.watermarks.get(library, {'watermark': 0, 'full_scan': 0})
+        if watermark is not None:
+            data['watermark'] = max(data.get('watermark'), watermark.timestamp())
+        if full_scan:
+            data['full_scan'] = time.time()
+
+        self.watermarks[library] = data
+        utils.save_json(self.watermarks, self.filepath)
 
 
 class PlexAnime:
-    def __init__(self, title: str, tvdbid: str, show_data, mapping: Mapping) -> None:
-        self.mapping = mapping
+    def __init__(self, title: str, tvdbid: str, show_data, previous: Optional['PlexAnime'] = None) -> None:
+        """ A plex season, or the part of one that belongs to a single anidb entry once split.
+        :param previous: The season before this one, None for the first season.
+        """
         self.title = f"{title} {show_data.title}"
-        self.watched_episodes = len([x for x in show_data.episodes() if x.isWatched])
+        self.show_data = show_data
+        self.watched_episodes = self.get_watched_episodes(show_data)
+        self.episode_count = getattr(show_data, 'leafCount', None)
         self.tvdb_id = tvdbid
         self.season_number = str(show_data.seasonNumber)
-        log(f"Loading anime {self.title}")
-        self.mal_id = self.mapping.get_mal_id(self.tvdb_id, self.season_number)
+        self.previous = previous
+        self.episode_start = 1
+        self.anidb_id = None
+        # Whether each episode number is watched, only loaded for seasons that are split or numbered absolutely
+        self.episodes_loaded = False
+        self.episode_numbers = None
+        # Filled in by Mapping.resolve_shows after the scan, so scanning doesn't have to wait for the mapping to load
+        self.mal_id = None
+
+    @property
+    def mapping_season(self) -> str:
+        """ The season the mapping is stored under as season@first episode, whole seasons start at episode 1. """
+        return f"{self.season_number}@{self.episode_start}"
+
+    @property
+    def absolute_start(self) -> Optional[int]:
+        """ The number of episodes before the season in absolute numbering, None when it can't be worked out.
+
+        It is the sum of the highest episode numbers of the earlier seasons, so episodes missing from the library
+        don't shift the seasons after them. Episodes missing from the end of an earlier season still do, plex
+        doesn't know how many episodes a season has on tvdb.
+        """
+        if self.previous is None:
+            return 0
+
+        previous_start = self.previous.absolute_start
+        previous_last = self.previous.last_episode
+        if previous_start is None or previous_last is None:
+            return None
+        return previous_start + previous_last
+
+    @property
+    def last_episode(self) -> Optional[int]:
+        """ The highest episode number of the season in plex, None when its episodes couldn't be loaded. """
+        episode_numbers = self.get_episode_numbers()
+        return max(episode_numbers, default = 0) if episode_numbers is not None else None
+
+    def get_last_watched_episode(self) -> int:
+        """ The highest watched episode number, the watched episode count when the episodes couldn't be loaded. """
+        episode_numbers = self.get_episode_numbers()
+        if episode_numbers is None:
+            return self.watched_episodes
+        return max((x for x, watched in episode_numbers.items() if watched), default = 0)
+
+    def get_episode_numbers(self) -> Optional[dict]:
+        """ Gets whether each episode number of the season is watched, None when the episodes couldn't be loaded. """
+        if not self.episodes_loaded:
+            self.episodes_loaded = True
+            try:
+                self.episode_numbers = {x.index: x.isWatched for x in self.show_data.episodes() if x.index is not None}
+            except (PlexApiException, requests.RequestException) as e:
+                log(f"Failed to load the episodes of {self.title}. {e}")
+        return self.episode_numbers
+
+    def split(self, segments: list) -> list:
+        """ Splits the season into a part for every anidb entry it spans.
+
+        Episodes are assumed to be watched in order, so a part's watched episodes are the ones of its anidb
+        entry up to the last watched episode of the season, including those in earlier seasons. Episode numbers
+        rather than counts are compared with the segments, so episodes missing from the library don't move the
+        watched episodes into another part.
+        :param segments: The [start, end, anidb_id, episode_offset] segments of the season from the mapping index.
+        :return: A PlexAnime for every segment.
+        """
+        # Absolutely numbered segments carry on into the next seasons. The highest episode number is at least the
+        # episode count, so the episodes are only loaded for segments starting after it
+        if self.episode_count:
+            segments = [x for x in segments if x[0] <= self.episode_count or x[0] <= (self.last_episode or 0)]
+
+        # A season that is a single anidb entry from its first episode keeps its watched episode count
+        whole = len(segments) == 1 and segments[0][0] == 1 and segments[0][3] == 0
+        last_watched_episode = self.watched_episodes if whole else self.get_last_watched_episode()
+        parts = []
+        for start, end, anidb_id, episode_offset in segments:
+            part = copy.copy(self)
+            part.episode_start = start
+            part.anidb_id = anidb_id
+            if len(segments) > 1:
+                part.title = f"{self.title} episodes {start}-{end if end is not None else ''}"
+
+            last_watched = last_watched_episode if end is None else min(last_watched_episode, end)
+            part.watched_episodes = max(0, last_watched - episode_offset) if last_watched >= start else 0
+            parts.append(part)
+        return parts
 
-        # If mal_id isn't found add the anime to the mapping errors
-        if self.mal_id is None:
-            mapping.add_to_mapping_errors(self.tvdb_id, self.title, self.season_number)
+    @staticmethod
+    def get_watched_episodes(show_data) -> int:
+        # Seasons come with their watched episode count, the episodes are only loaded when it's missing
+        if getattr(show_data, 'viewedLeafCount', None) is not None:
+            return show_data.viewedLeafCount
+        return len([x for x in show_data.episodes() if x.isWatched])
 
     def __repr__(self):
         return f"Title: {self.title}\n  tvdb_id: {self.tvdb_id}\n  mal_id: {self.mal_id}\n  Watched episodes: {self.watched_episodes}"
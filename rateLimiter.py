@@ -0,0 +1,39 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1) -> None:
+        """ Thread safe token bucket limiting how often something may happen.
+        :param rate: The number of tokens added per second.
+        :param capacity: The most tokens that can be saved up for a burst.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """ Takes a token if one is available.
+        :return: 0 when a token was taken, otherwise the seconds until the next one is.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> None:
+        """ Blocks until a token is available and takes it. """
+        while (wait := self.take()) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        """ Waits for a token without blocking the event loop and takes it. """
+        while (wait := self.take()) > 0:
+            await asyncio.sleep(wait)
@@ -0,0 +1,178 @@
+import queue
+import threading
+import time
+from typing import Callable
+
+from database import Database
+from driver import LazyDriver
+from listWriter import ListWriter, UpdateResult
+from mapping import Mapping
+from metrics import metrics
+from rateLimiter import TokenBucket
+from updateData import UpdateData
+from utils import log
+
+
+class SyncExecutor:
+    def __init__(self, mapping: Mapping, list_writer: ListWriter, database: Database, mal_username: str) -> None:
+        """ Applies a plan of updates to a myanimelist list.
+        :param mapping: Receives anime whose mal_id turns out to be invalid as mapping errors.
+        :param list_writer: The writer updates are applied with.
+        :param database: Where the state of applied updates is recorded.
+        :param mal_username: The user whose list is updated.
+        """
+        self.mapping = mapping
+        self.list_writer = list_writer
+        self.database = database
+        self.mal_username = mal_username
+
+    def execute(self, plan: list) -> bool:
+        """ Applies every update of the plan.
+        :return: Whether none of the updates failed, anime with invalid ids are in the mapping errors instead.
+        """
+        all_applied = True
+        for update in plan:
+            result = self.apply_update(update)
+            if result == UpdateResult.LOGIN_FAILED:
+                # Every other update would fail the same way and only add to the login attempts
+                log("Stopping the sync, the remaining updates are tried next sync")
+                return False
+            all_applied = all_applied and self.succeeded(result)
+        return all_applied
+
+    @staticmethod
+    def succeeded(result: UpdateResult) -> bool:
+        return result in (UpdateResult.UPDATED, UpdateResult.INVALID_ID)
+
+    def apply_update(self, update: UpdateData) -> UpdateResult:
+        log(f"Updating series {update.title}")
+        with metrics.span('apply_update'):
+            result = self.list_writer.update(update)
+        self.record_result(update, result)
+        return result
+
+    def record_result(self, update: UpdateData, result: UpdateResult) -> None:
+        metrics.increment('updates_applied' if result == UpdateResult.UPDATED else 'updates_failed')
+        if result == UpdateResult.LOGIN_FAILED:
+            log("Failed to log into MyAnimeList")
+
+        elif result == UpdateResult.INVALID_ID:
+            log("Error can't load page with that mal id")
+            self.mapping.add_to_mapping_errors(update.tvdb_id, update.title, update.season)
+
+        elif result == UpdateResult.FAILED:
+            log(f"Failed to update {update.title}")
+
+        else:
+            self.database.set_sync_state(self.mal_username, update.mal_id, update.watched_episodes, update.status)
+
+
+class ParallelSyncExecutor(SyncExecutor):
+    def __init__(self, mapping: Mapping, create_list_writer: Callable[[LazyDriver], ListWriter], database: Database,
+                 mal_username: str, workers: int = 2, rate: float = 1.0, retries: int = 2,
+                 create_driver: Callable[[], LazyDriver] = LazyDriver) -> None:
+        """ Applies a plan of updates with several workers, each with its own list writer and web driver.
+        :param mapping: Receives anime whose mal_id turns out to be invalid as mapping errors.
+        :param create_list_writer: Creates the list writer of a worker from the worker's web driver.
+        :param database: Where the state of applied updates is recorded.
+        :param mal_username: The user whose list is updated.
+        :param workers: The number of updates applied at once.
+        :param rate: The most updates started per second across all workers.
+        :param retries: The number of times a failed update is tried again.
+        :param create_driver: Creates the web driver of a worker.
+        """
+        super().__init__(mapping, None, database, mal_username)
+        self.create_list_writer = create_list_writer
+        self.workers = workers
+        self.retries = retries
+        self.create_driver = create_driver
+        self.rate_limiter = TokenBucket(rate)
+        # Set by the first worker that fails to log in, the others stop taking updates
+        self.login_failed = threading.Event()
+
+    def execute(self, plan: list) -> bool:
+        updates = queue.Queue()
+        for update in plan:
+            updates.put(update)
+
+        self.login_failed.clear()
+        results = queue.Queue()
+        threads = [threading.Thread(target = self.work, args = (updates, results), daemon = True)
+                   for _ in range(min(self.workers, len(plan)))]
+        for thread in threads:
+            thread.start()
+
+        # Results are recorded here so the workers never touch the mappings, each worker ends with None
+        applied = 0
+        failed = []
+        finished = 0
+        while finished < len(threads):
+            item = results.get()
+            if item is None:
+                finished += 1
+                continue
+
+            update, result = item
+            self.record_result(update, result)
+            if self.succeeded(result):
+                applied += 1
+            else:
+                failed.append(update.title)
+
+        for thread in threads:
+            thread.join()
+
+        skipped = len(plan) - applied - len(failed)
+        log(f"Applied {applied} of {len(plan)} updates")
+        if failed:
+            log(f"Failed to update: {', '.join(failed)}")
+        if skipped:
+            log(f"{skipped} updates weren't tried and are tried next sync")
+        return not failed and not skipped
+
+    def work(self, updates: queue.Queue, results: queue.Queue) -> None:
+        driver = None
+        list_writer = None
+        try:
+            driver = self.create_driver()
+            list_writer = self.create_list_writer(driver)
+            while not self.login_failed.is_set():
+                try:
+                    update = updates.get_nowait()
+                except queue.Empty:
+                    return
+
+                result = self.apply_with_retries(list_writer, update)
+                if result == UpdateResult.LOGIN_FAILED:
+                    self.login_failed.set()
+                results.put((update, result))
+        except Exception as e:
+            log(f"Update worker stopped. {e}")
+        finally:
+            if list_writer is not None:
+                list_writer.close()
+            if driver is not None:
+                driver.quit()
+            # Always report the worker as done, even when it couldn't start
+            results.put(None)
+
+    def apply_with_retries(self, list_writer: ListWriter, update: UpdateData) -> UpdateResult:
+        result = UpdateResult.FAILED
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            log(f"Updating series {update.title}")
+            try:
+                with metrics.span('apply_update'):
+                    result = list_writer.update(update)
+            except Exception as e:
+                # A crashed worker would leave its update without a result
+                log(f"Error updating {update.title}. {e}")
+                result = UpdateResult.FAILED
+
+            # Logging in again for every update would only add to the login attempts
+            if result in (UpdateResult.UPDATED, UpdateResult.INVALID_ID, UpdateResult.LOGIN_FAILED):
+                return result
+            if attempt < self.retries:
+                time.sleep(2 ** attempt)
+
+        return result
@@ -1,67 +1,192 @@
-from plexConnection import PlexConnection, PlexAnime
-from updateData import UpdateData
+import asyncio
+import threading
+from typing import Callable, Tuple
+
+from plexConnection import PlexConnection, ScanWatermarks
 from utils import log
-from config import Config
+from config import Account, Config, USER_AGENT
+from database import Database
 from animeList import AnimeList
-from driver import Driver
+from asyncFetcher import AsyncFetcher, get_host
+from driver import LazyDriver
+from listWriter import create_list_writer
 from mapping import Mapping
-
-
-def update_required(plex_anime, list_anime):
-    plex_we = plex_anime.watched_episodes
-    list_we = list_anime.watched_episodes
-    list_te = list_anime.total_episodes
-
-    # Conditions for needing to be updated
-    anime_not_listed = list_anime is None
-    anime_list_behind = (list_we < plex_we) and (plex_we <= list_te or list_te == -1)
-    anime_completed = plex_we >= list_te != -1 and list_anime.status != 'completed'
-
-    return anime_not_listed or anime_completed or anime_list_behind
-
-
-def enter_watch_status(update: UpdateData, driver: Driver):
-    if update.status is None:
-        update.set_myanimelist_total_episodes(driver.get_total_episodes())
-
-    driver.select_watch_status(update.status)
-
-
-def apply_update(update: UpdateData, config: Config, mapping: Mapping, driver: Driver):
-    log(f"Updating series {update.title}")
-    if not driver.login_myanimelist(config.mal_username, config.mal_password):
-        log("Failed to log into MyAnimeList")
-        return
-
-    if update.mal_id is None:
-        log(f"No id for {update.title}")
-        return
-
-    # Load the anime page
-    if not driver.load_anime_page(update.mal_id):
-        log("Error can't load page with that mal id")
-        mapping.add_to_mapping_errors(update.tvdb_id, update.title, update.season)
-        return
-
-    log("Filling in information")
-    driver.add_to_list()
-    enter_watch_status(update, driver)
-    driver.enter_episodes_seen(update.watched_episodes)
-    driver.confirm_update()
-
-
-def start_sync(config: Config):
-    driver = Driver()
-    mapping = Mapping(driver)
-    plex_connection = PlexConnection(config.server_url, config.server_token, mapping)
-    anime_list = AnimeList(config.mal_username)
-
-    # Sync selected libraries
-    for plex_library in config.libraries:
-        for show in plex_connection.get_shows(plex_library):
-            list_anime = anime_list.get_anime(show.mal_id)
-            if list_anime is None or update_required(show, list_anime):
-                apply_update(UpdateData(show, list_anime), config, mapping, driver)
-
-    driver.quit()
-    log("Sync complete")
+from metrics import metrics
+from syncExecutor import SyncExecutor, ParallelSyncExecutor
+from syncPlanner import build_plan, print_plan, remove_pushed_updates
+
+# Full and webhook syncs share the database, the scan watermarks and the session cookies so only one runs at a time
+sync_lock = threading.Lock()
+
+
+def start_sync(config: Config, dry_run: bool = False):
+    """ Syncs the watched episodes of the configured plex libraries to myanimelist for every account.
+    :param dry_run: Only print the planned updates instead of applying them.
+    """
+    watermarks = {x.mal_username: ScanWatermarks(config.full_scan_days, get_watermarks_path(x)) for x in config.accounts}
+    scans = {}
+
+    def scan(plex_connection: PlexConnection, account: Account) -> list:
+        # Scan selected libraries, only shows that changed since the account's last sync unless a full scan is due
+        shows = []
+        for plex_library in account.libraries:
+            since = watermarks[account.mal_username].get_since(plex_library)
+            library_shows, watermark = plex_connection.scan_library(plex_library, since)
+            shows.extend(library_shows)
+            scans.setdefault(account.mal_username, {})[plex_library] = (watermark, since is None)
+        return shows
+
+    synced = sync_shows(config, scan, dry_run)
+    for mal_username in synced:
+        for plex_library, (watermark, full_scan) in scans.get(mal_username, {}).items():
+            watermarks[mal_username].set_watermark(plex_library, watermark, full_scan)
+    if synced:
+        log("Sync complete")
+
+
+def start_season_sync(config: Config, seasons: dict):
+    """ Syncs only the given seasons, as reported by plex webhooks.
+
+    Every account is synced, seasons an account hasn't watched more of don't make any updates.
+    :param seasons: Season numbers keyed by the rating key of their show.
+    """
+    log(f"Syncing {sum(len(x) for x in seasons.values())} seasons from webhooks")
+    if sync_shows(config, lambda plex_connection, account: plex_connection.get_show_seasons(seasons)):
+        log("Season sync complete")
+
+
+def get_watermarks_path(account: Account) -> str:
+    return f"data/plex_watermarks_{account.mal_username}.json"
+
+
+def sync_shows(config: Config, scan: Callable[[PlexConnection, Account], list], dry_run: bool = False) -> list:
+    """ Maps, plans and applies the updates for the shows returned by scan for every account.
+
+    The mapping index, anidb cache and database are loaded once and shared by the accounts, and the seasons
+    of every account are mapped together so a season several accounts watched is only resolved once.
+    :param scan: Gets the PlexAnime objects to sync from an account's plex connection.
+    :param dry_run: Only print the planned updates instead of applying them.
+    :return: The myanimelist usernames of the accounts whose updates were applied.
+    """
+    def create_driver() -> LazyDriver:
+        return LazyDriver(config.driver_timeout, config.driver_poll_interval)
+
+    with sync_lock:
+        metrics.start_run()
+        driver = create_driver()
+        database = Database()
+        mapping = None
+        try:
+            mapping, sources = asyncio.run(load_sources(config, scan, driver, database))
+
+            # Mapping is done with the browser, each account's fallback list writer logs in with its own
+            driver.quit()
+
+            synced = []
+            for account, shows, anime_list in sources:
+                try:
+                    for loaded in (shows, anime_list):
+                        if isinstance(loaded, Exception):
+                            raise loaded
+                    if sync_account(config, account, shows, anime_list, mapping, database, dry_run, create_driver):
+                        synced.append(account.mal_username)
+                    elif not dry_run:
+                        # Shows behind the watermark aren't scanned again, so failed updates keep it where it was
+                        log(f"Not every update for account {account.mal_username} was applied, "
+                            f"its changed shows are scanned again next sync")
+                except Exception as e:
+                    # One account failing doesn't stop the others, its watermarks aren't moved so it's retried
+                    log(f"Failed to sync account {account.mal_username}. {e}")
+            return synced
+        finally:
+            driver.quit()
+            if mapping is not None:
+                mapping.close()
+            database.close()
+            metrics.finish_run()
+
+
+async def load_sources(config: Config, scan: Callable[[PlexConnection, Account], list], driver: LazyDriver,
+                       database: Database) -> Tuple[Mapping, list]:
+    """ Loads the mapping, scans plex and loads the anime lists at the same time, then maps the scanned seasons.
+
+    The mapping files and plex are read with blocking libraries in worker threads while the anime lists are
+    fetched on the event loop, so this takes about as long as the slowest of them rather than their sum.
+    :return: The loaded mapping and an (account, shows, anime list) tuple for every account, the shows or anime list
+             are the exception raised instead when they failed to load so one account can't stop the others.
+    """
+    loop = asyncio.get_running_loop()
+
+    def load_mapping() -> Mapping:
+        with metrics.span('mapping_load'):
+            return Mapping(driver, database, config.anidb_workers, config.anidb_rate,
+                           cross_reference_url = config.cross_reference_url, mapping_url = config.mapping_url,
+                           anidb_url = config.anidb_url)
+
+    def scan_account(account: Account) -> list:
+        # Watched state is per plex user, so each account scans with its own token
+        with metrics.span('plex_scan'):
+            shows = scan(PlexConnection(config.server_url, account.server_token, config.scan_workers), account)
+        metrics.increment('seasons_scanned', len(shows))
+        return shows
+
+    def split_accounts(mapping: Mapping, account_shows: list) -> list:
+        return [x if isinstance(x, Exception) else mapping.split_seasons(x) for x in account_shows]
+
+    async def load_anime_list(account: Account) -> AnimeList:
+        with metrics.span('anime_list_load'):
+            return await AnimeList(account.mal_username, mal_url = config.mal_url).load(fetcher)
+
+    fetcher = AsyncFetcher({get_host(config.anidb_url): config.anidb_workers}, timeout = config.fetch_timeout,
+                           headers = {'User-Agent': USER_AGENT})
+    async with fetcher:
+        mapping_load = loop.run_in_executor(None, load_mapping)
+        scans = asyncio.gather(*(loop.run_in_executor(None, scan_account, x) for x in config.accounts),
+                               return_exceptions = True)
+        anime_lists = asyncio.gather(*(load_anime_list(x) for x in config.accounts), return_exceptions = True)
+        try:
+            mapping, account_shows = await asyncio.gather(mapping_load, scans)
+        except BaseException:
+            # Don't leave the list loads running on a fetcher that is about to close
+            anime_lists.cancel()
+            raise
+
+        # Map every new season at once so the anidb pages can be fetched concurrently
+        with metrics.span('mapping_resolve'):
+            # Seasons spanning several anidb entries are synced to each of their myanimelist entries. Splitting
+            # can load episodes from plex, so it runs in a worker thread to keep the anime list loads going
+            account_shows = await loop.run_in_executor(None, split_accounts, mapping, account_shows)
+            await mapping.resolve_shows_async([x for shows in account_shows if not isinstance(shows, Exception)
+                                               for x in shows], fetcher)
+            mapping.checkpoint()
+
+        return mapping, list(zip(config.accounts, account_shows, await anime_lists))
+
+
+def sync_account(config: Config, account: Account, shows: list, anime_list: AnimeList, mapping: Mapping,
+                 database: Database, dry_run: bool, create_driver: Callable[[], LazyDriver]) -> bool:
+    """ Plans and applies the updates of one account.
+    :return: Whether every update was applied, the account's scan watermarks are only moved on when they were.
+    """
+    log(f"Syncing account {account.mal_username}")
+    plan = build_plan(shows, anime_list)
+    plan = remove_pushed_updates(plan, database, account.mal_username, config.push_cache_days * 86_400)
+    print_plan(plan)
+    metrics.increment('updates_planned', len(plan))
+    if dry_run:
+        log("Dry run, no updates applied")
+        return False
+
+    if config.update_workers > 1:
+        executor = ParallelSyncExecutor(mapping, lambda x: create_list_writer(config, account, x), database,
+                                        account.mal_username, config.update_workers, config.update_rate,
+                                        create_driver = create_driver)
+        return executor.execute(plan)
+
+    driver = create_driver()
+    list_writer = create_list_writer(config, account, driver)
+    try:
+        return SyncExecutor(mapping, list_writer, database, account.mal_username).execute(plan)
+    finally:
+        list_writer.close()
+        driver.quit()
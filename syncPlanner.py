@@ -0,0 +1,80 @@
+import time
+
+from animeList import AnimeList
+from database import Database
+from updateData import UpdateData
+from utils import log
+
+
+def update_required(plex_anime, list_anime):
+    plex_we = plex_anime.watched_episodes
+    list_we = list_anime.watched_episodes
+    list_te = list_anime.total_episodes
+
+    # Conditions for needing to be updated
+    anime_not_listed = list_anime is None
+    anime_list_behind = (list_we < plex_we) and (plex_we <= list_te or list_te == -1)
+    anime_completed = plex_we >= list_te != -1 and list_anime.status != 'completed'
+
+    return anime_not_listed or anime_completed or anime_list_behind
+
+
+def build_plan(shows: list, anime_list: AnimeList) -> list:
+    """ Works out every update needed to bring the list in line with plex before any are applied.
+
+    Several plex seasons can map to the same myanimelist entry, only the furthest watched one is kept.
+    :param shows: PlexAnime objects with their mal_id resolved.
+    :param anime_list: The myanimelist list to compare against.
+    :return: A list of UpdateData objects, one per mal_id.
+    """
+    plan = {}
+    list_animes = anime_list.get_anime_bulk({x.mal_id for x in shows if x.mal_id is not None})
+    for show in shows:
+        if show.mal_id is None:
+            continue
+
+        list_anime = list_animes.get(show.mal_id)
+        if list_anime is not None and not update_required(show, list_anime):
+            continue
+
+        planned = plan.get(show.mal_id)
+        if planned is None or show.watched_episodes > planned.plex_watched_episodes:
+            plan[show.mal_id] = UpdateData(show, list_anime)
+
+    return list(plan.values())
+
+
+def already_pushed(update: UpdateData, sync_state: tuple, max_age: float) -> bool:
+    watched_episodes, status, synced_at = sync_state
+    # The status of unlisted anime is only worked out when applied so only the episodes can be compared
+    same_status = update.status is None or update.status == status
+    return watched_episodes == update.watched_episodes and same_status and time.time() - synced_at < max_age
+
+
+def remove_pushed_updates(plan: list, database: Database, mal_username: str, max_age: float) -> list:
+    """ Drops updates identical to the last one pushed for the same anime.
+
+    The scraped list can lag behind or disagree with what was written, which would otherwise push the
+    same update every sync. Pushes older than max_age are repeated in case the list was changed since.
+    :param plan: The planned updates.
+    :param database: Where the state of applied updates is recorded.
+    :param mal_username: The user whose list is updated.
+    :param max_age: Seconds a pushed update is trusted for.
+    :return: The updates still needed.
+    """
+    needed = []
+    for update in plan:
+        sync_state = database.get_sync_state(mal_username, update.mal_id)
+        if sync_state is not None and already_pushed(update, sync_state, max_age):
+            log(f"Skipping {update.title}, already pushed")
+            continue
+        needed.append(update)
+    return needed
+
+
+def print_plan(plan: list) -> None:
+    log(f"{len(plan)} updates planned")
+    for update in plan:
+        listed = update.myanimelist_watched_episodes if update.myanimelist_watched_episodes is not None else 'unlisted'
+        log(f"  {update.title} (mal_id {update.mal_id}): {listed} -> {update.watched_episodes} episodes, "
+            f"status {update.status or 'decided when applied'}")
@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+from mappingIndex import MappingIndex
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'anime-list.xml')
+
+
+class MappingIndexTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.database = Database(':memory:')
+        self.index = MappingIndex(FIXTURE, self.database)
+
+    def tearDown(self) -> None:
+        self.database.close()
+
+    def test_episode_offset_splits_season(self):
+        self.assertEqual(self.index.get_segments('100', '1'), [[1, 12, '1', 0], [13, None, '2', 12]])
+
+    def test_absolute_season_is_shifted_by_its_start(self):
+        self.assertEqual(self.index.get_segments('200', '2'), [])
+        self.assertEqual(self.index.get_season_segments('200', '1', 0), [[1, 24, '3', 0], [25, None, '4', 24]])
+        self.assertEqual(self.index.get_season_segments('200', '2', 12), [[1, 12, '3', -12], [13, None, '4', 12]])
+        # Segments ending before the season starts are dropped
+        self.assertEqual(self.index.get_season_segments('200', '3', 24), [[1, None, '4', 0]])
+
+    def test_absolute_fallback_needs_its_start(self):
+        self.assertEqual(self.index.get_season_segments('200', '2'), [])
+        self.assertIsNone(self.index.get_anidb_id('200', '2'))
+
+    def test_range_with_negative_offset_takes_precedence(self):
+        self.assertEqual(self.index.get_segments('300', '1'), [[1, None, '5', 0]])
+        self.assertEqual(self.index.get_segments('300', '2'), [[1, 12, '5', -12], [13, None, '6', 12]])
+
+    def test_entries_sharing_an_offset_keep_the_first(self):
+        self.assertEqual(self.index.get_segments('400', '1'), [[1, None, '7', 0]])
+
+    def test_entries_without_a_tvdb_id_are_skipped(self):
+        self.assertEqual(self.database.execute("SELECT COUNT(*) FROM anidb_segments WHERE anidb_id = '9'"), [(0,)])
+
+    def test_get_anidb_id_by_episode(self):
+        self.assertEqual(self.index.get_anidb_id('100', '1'), '1')
+        self.assertEqual(self.index.get_anidb_id('100', '1@13'), '2')
+        self.assertEqual(self.index.get_anidb_id('200', '2@13', 12), '4')
+        self.assertIsNone(self.index.get_anidb_id('999', '1'))
+
+    def test_range_starting_before_the_season_is_clipped(self):
+        segments = MappingIndex.build_segments([('500', '1', '10', 0)], [('500', '1', '11', 1, 24, -12)])
+        self.assertEqual(segments, [('500', '1', 1, 12, '11', -12), ('500', '1', 13, None, '10', 0)])
+
+    def test_index_is_reused_until_the_file_changes(self):
+        self.database.execute('DELETE FROM anidb_segments')
+        MappingIndex(FIXTURE, self.database)
+        self.assertEqual(self.database.execute('SELECT COUNT(*) FROM anidb_segments'), [(0,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
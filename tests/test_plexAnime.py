@@ -0,0 +1,66 @@
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plexConnection import PlexAnime
+
+
+def create_season(number: int, episodes: list, last_watched: int) -> SimpleNamespace:
+    """ A stand-in for a plex season with the given episode numbers, watched up to last_watched. """
+    episodes = [SimpleNamespace(index = x, isWatched = x <= last_watched) for x in episodes]
+    return SimpleNamespace(title = f"Season {number}", seasonNumber = number, leafCount = len(episodes),
+                           viewedLeafCount = sum(x.isWatched for x in episodes), episodes = lambda: episodes)
+
+
+class PlexAnimeTest(unittest.TestCase):
+    def test_whole_season_keeps_its_watched_count(self):
+        anime = PlexAnime('Show', '100', create_season(1, list(range(1, 13)), 5))
+        parts = anime.split([[1, None, '1', 0]])
+        self.assertEqual([(x.anidb_id, x.mapping_season, x.watched_episodes) for x in parts], [('1', '1@1', 5)])
+
+    def test_watched_episodes_per_part(self):
+        anime = PlexAnime('Show', '100', create_season(1, list(range(1, 25)), 15))
+        parts = anime.split([[1, 12, '1', 0], [13, None, '2', 12]])
+        self.assertEqual([(x.anidb_id, x.mapping_season, x.watched_episodes) for x in parts],
+                         [('1', '1@1', 12), ('2', '1@13', 3)])
+
+    def test_unwatched_part_has_no_watched_episodes(self):
+        anime = PlexAnime('Show', '100', create_season(1, list(range(1, 25)), 4))
+        parts = anime.split([[1, 12, '1', 0], [13, None, '2', 12]])
+        self.assertEqual([x.watched_episodes for x in parts], [4, 0])
+
+    def test_missing_episodes_don_t_move_watched_episodes(self):
+        # Episodes 7 to 11 aren't in the library, so the episode count is lower than the last episode
+        anime = PlexAnime('Show', '100', create_season(1, [1, 2, 3, 4, 5, 6, 12], 12))
+        parts = anime.split([[1, 6, '1', 0], [7, None, '2', 6]])
+        self.assertEqual([(x.anidb_id, x.watched_episodes) for x in parts], [('1', 6), ('2', 6)])
+
+    def test_segments_after_the_last_episode_are_dropped(self):
+        anime = PlexAnime('Show', '200', create_season(1, list(range(1, 13)), 12))
+        parts = anime.split([[1, 12, '3', 0], [13, None, '4', 12]])
+        self.assertEqual([x.anidb_id for x in parts], ['3'])
+
+    def test_absolute_start_uses_episode_numbers(self):
+        first = PlexAnime('Show', '200', create_season(1, [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12], 12))
+        second = PlexAnime('Show', '200', create_season(2, list(range(1, 13)), 0), first)
+        third = PlexAnime('Show', '200', create_season(3, list(range(1, 13)), 0), second)
+        self.assertEqual((first.absolute_start, second.absolute_start, third.absolute_start), (0, 12, 24))
+
+    def test_absolute_start_is_unknown_without_episodes(self):
+        def fail():
+            raise requests.ConnectionError('plex is unreachable')
+
+        first_season = create_season(1, list(range(1, 13)), 0)
+        first_season.episodes = fail
+        first = PlexAnime('Show', '200', first_season)
+        second = PlexAnime('Show', '200', create_season(2, list(range(1, 13)), 0), first)
+        self.assertIsNone(second.absolute_start)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,7 +9,7 @@ class UpdateData:
         self.mal_id = plex_anime.mal_id
         self.tvdb_id = plex_anime.tvdb_id
         self.title = plex_anime.title
-        self.season = plex_anime.season_number
+        self.season = plex_anime.mapping_season
 
         self.plex_watched_episodes = plex_anime.watched_episodes
         self.myanimelist_total_episodes = list_anime.total_episodes if list_anime is not None else None
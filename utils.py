@@ -1,4 +1,5 @@
 import os
+import tempfile
 from datetime import datetime
 import json
 
@@ -15,6 +16,20 @@ def load_mapping():
     return load_json('data/tvdbid_to_malid.json')
 
 
+def get_cookies_path(mal_username: str) -> str:
+    return f"data/mal_cookies_{mal_username}.json"
+
+
+def load_cookies(mal_username: str) -> list:
+    """ Loads the saved MyAnimeList cookies of a user in the format selenium uses. """
+    filepath = get_cookies_path(mal_username)
+    return load_json(filepath) if os.path.exists(filepath) else []
+
+
+def save_cookies(cookies: list, mal_username: str) -> None:
+    save_json(cookies, get_cookies_path(mal_username))
+
+
 def load_json(filepath: str):
     if not os.path.exists(filepath):
         save_json({}, filepath)
@@ -24,5 +39,12 @@ def load_json(filepath: str):
 
 
 def save_json(data, filepath: str):
-    with open(filepath, 'w') as f:
-        json.dump(data, f)
+    """ Saves data as json, replacing the file atomically so it is never left half written. """
+    fd, temp_path = tempfile.mkstemp(dir = os.path.dirname(filepath) or '.', prefix = '.save-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, filepath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
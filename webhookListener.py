@@ -0,0 +1,131 @@
+import hmac
+import json
+import threading
+import time
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
+
+from utils import log
+
+
+def parse_payload(content_type: str, body: bytes) -> Optional[dict]:
+    """ Reads the json payload out of a plex webhook request, which plex sends as multipart form data. """
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+
+    message = BytesParser(policy = policy.HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    if not message.is_multipart():
+        return None
+
+    for part in message.iter_parts():
+        if part.get_param('name', header = 'content-disposition') == 'payload':
+            return json.loads(part.get_payload(decode = True))
+    return None
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.server.listener.is_authorised(self.path):
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.end_headers()
+
+        try:
+            payload = parse_payload(self.headers.get('Content-Type', ''), body)
+        except ValueError as e:
+            log(f"Ignoring unreadable webhook. {e}")
+            return
+
+        if payload is not None:
+            self.server.listener.handle_event(payload)
+
+    def log_message(self, format, *args):
+        # Plex sends a webhook for every play and pause, don't log each request
+        pass
+
+
+class WebhookListener:
+    def __init__(self, port: int, on_seasons: Callable[[dict], None], libraries: list, debounce: float = 60,
+                 max_delay: float = 600, host: str = '127.0.0.1', token: Optional[str] = None) -> None:
+        """ Listens for plex webhooks and syncs the seasons of scrobbled episodes.
+
+        Events are collected until none arrive for debounce seconds, or max_delay seconds after the first
+        one, so a binge of episodes becomes a single sync.
+        :param port: The port to listen on.
+        :param on_seasons: Called with the collected season numbers keyed by the rating key of their show.
+        :param libraries: Only episodes from these libraries are synced.
+        :param debounce: Seconds without events to wait before syncing.
+        :param max_delay: The longest time to keep collecting events before syncing.
+        :param host: The address to listen on, only this machine can send webhooks by default.
+        :param token: The token query parameter webhooks must carry, webhooks aren't checked when None.
+        """
+        self.port = port
+        self.host = host
+        self.token = token
+        self.on_seasons = on_seasons
+        self.libraries = libraries
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.pending = {}
+        self.first_event = None
+        self.timer = None
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self) -> None:
+        self.server = ThreadingHTTPServer((self.host, self.port), WebhookHandler)
+        self.server.listener = self
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        log(f"Listening for plex webhooks on {self.host}:{self.port}")
+
+    def is_authorised(self, path: str) -> bool:
+        if self.token is None:
+            return True
+        token = parse_qs(urlparse(path).query).get('token', [''])[0]
+        return hmac.compare_digest(token.encode(), self.token.encode())
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handle_event(self, payload: dict) -> None:
+        metadata = payload.get('Metadata', {})
+        if payload.get('event') != 'media.scrobble' or metadata.get('type') != 'episode':
+            return
+
+        if metadata.get('librarySectionTitle') not in self.libraries:
+            return
+
+        log(f"Plex scrobbled {metadata.get('grandparentTitle')} {metadata.get('parentTitle')}")
+        with self.lock:
+            self.pending.setdefault(str(metadata.get('grandparentRatingKey')), set()).add(str(metadata.get('parentIndex')))
+            if self.first_event is None:
+                self.first_event = time.monotonic()
+
+            # Keep pushing the sync back while events arrive, up to the max delay
+            if self.timer is not None:
+                self.timer.cancel()
+            delay = min(self.debounce, max(0.0, self.first_event + self.max_delay - time.monotonic()))
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.first_event = None
+            self.timer = None
+
+        if pending:
+            try:
+                self.on_seasons(pending)
+            except Exception as e:
+                log(f"Webhook sync failed. {e}")